@@ -4,4 +4,6 @@ __red_end_user_data_statement__ = "This cog stores id of users manually marked a
 
 
 async def setup(bot):
-    bot.add_cog(AutoMod(bot)) if not __import__('asyncio').iscoroutinefunction(bot.add_cog) else await bot.add_cog(AutoMod(bot))
+    n = AutoMod(bot)
+    bot.add_cog(n) if not __import__('asyncio').iscoroutinefunction(bot.add_cog) else await bot.add_cog(n)
+    bot.loop.create_task(n.init())
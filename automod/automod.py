@@ -1,28 +1,49 @@
 import asyncio
 import logging
+import sqlite3
+import time
+import timeit
+import warnings
 from collections import defaultdict, deque
-from datetime import datetime
 from io import BytesIO
-from typing import Optional
+from typing import Any, Dict, NamedTuple, Optional, Tuple
 
 import discord
 import prettytable
-from pytz import UTC
 from redbot.core import Config, checks, commands
 from redbot.core.utils.chat_formatting import box, inline, pagify
 from tsutils.cog_settings import CogSettings
 from tsutils.formatting import strip_right_multiline
 
+from .queues import DeletionQueue, ReactionScheduler, ReportOutbox
+from .redos import analyse_pattern
+
 try:
     import regex as re
 except ImportError:
     import re
 
+# The literal prefilter only needs plain alternation, which the stdlib engine scans faster
+import re as stdlib_re
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
 logger = logging.getLogger('red.misc-cogs.automod')
 
 # Make sure to change the docstring in resetmessagecount when changing this
 LOGS_PER_CHANNEL_USER = 10
 
+# Image limit windows for users who haven't posted in this long are dropped
+IMAGE_LOG_IDLE_SECONDS = 60 * 60
+IMAGE_LOG_EVICTION_INTERVAL = 5 * 60
+
+# How often in-memory per-rule counters are added to the saved totals
+RULE_STATS_FLUSH_INTERVAL = 10 * 60
+
 AUTOMOD_HELP = r"""
 Automod works by creating named global patterns, and then applying them in
 specific channels as either whitelist or blacklist rules. This allows you
@@ -84,43 +105,230 @@ def linked_img_count(message):
     return len(message.embeds) + len(message.attachments)
 
 
+class ImageLogEntry:
+    __slots__ = ('message_id', 'created_at_ts', 'image_count')
+
+    def __init__(self, message_id, created_at_ts, image_count):
+        self.message_id = message_id
+        self.created_at_ts = created_at_ts
+        self.image_count = image_count
+
+
+class ImageLimitWindow:
+    """A user's recent messages in one channel, with a running total of their images."""
+    __slots__ = ('entries', 'total', 'max_age', 'last_seen')
+
+    def __init__(self):
+        self.entries = deque()
+        self.total = 0
+        self.max_age = None
+        self.last_seen = 0
+
+    def add(self, entry, max_messages, max_age, now):
+        self.entries.append(entry)
+        self.total += entry.image_count
+        self.max_age = max_age
+        self.last_seen = now
+
+        while len(self.entries) > max_messages:
+            self.total -= self.entries.popleft().image_count
+        if max_age is not None:
+            while self.entries and now - self.entries[0].created_at_ts >= max_age:
+                self.total -= self.entries.popleft().image_count
+        if self.total == 0:
+            self.entries.clear()
+
+    def clear(self):
+        self.entries.clear()
+        self.total = 0
+
+    def idle(self, now):
+        if self.max_age is not None and now - self.last_seen >= self.max_age:
+            return True
+        return now - self.last_seen >= IMAGE_LOG_IDLE_SECONDS
+
+
+class ImageLimitTracker:
+    """Sliding image count windows keyed by (channel id, user id)."""
+
+    def __init__(self):
+        self.windows = {}
+
+    def __len__(self):
+        return len(self.windows)
+
+    def record(self, channel_id, user_id, entry, max_messages, max_age, now):
+        key = (channel_id, user_id)
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = ImageLimitWindow()
+        window.add(entry, max_messages, max_age, now)
+        return window
+
+    def evict_idle(self, now):
+        idle = [key for key, window in self.windows.items() if window.idle(now)]
+        for key in idle:
+            del self.windows[key]
+        return len(idle)
+
+
+class MessageContext:
+    """Per-message state shared by every stage of the automod pipeline."""
+
+    def __init__(self, message, policy):
+        self.message = message
+        self.policy = policy
+        self.deleted = False
+        self._clean_content = None
+        self._moderatable = None
+
+    @property
+    def clean_content(self):
+        if self._clean_content is None:
+            self._clean_content = self.message.clean_content
+        return self._clean_content
+
+    @property
+    def moderatable(self):
+        """True if the author is a guild member without manage_messages in this channel."""
+        if self._moderatable is None:
+            author = self.message.author
+            self._moderatable = (isinstance(author, discord.Member)
+                                 and not self.message.channel.permissions_for(author).manage_messages)
+        return self._moderatable
+
+
 class AutoMod(commands.Cog):
     """Uses regex pattern matching to filter message content and set limits on users"""
 
-    def __init__(self, bot, *args, **kwargs):
+    def __init__(self, bot, *args, config=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.bot = bot
 
-        self.config = Config.get_conf(self, identifier=4770700)
-        self.config.register_guild(patterns={}, phrases={}, watched_users={}, watchdog_channel_id=None,
-                                   immune_role_ids=[], embed_immune_role_ids=[])
-        self.config.register_channel(whitelist=[], blacklist=[], autoemoji=[], image_only=False,
-                                     image_limit=1, reset_message_count=LOGS_PER_CHANNEL_USER, image_reset_minutes=5,
-                                     imagelimit_enabled=False, embedlimit_enabled=False, embed_limit=2)
+        # The replay benchmark passes in an in-memory config
+        if config is None:
+            config = Config.get_conf(self, identifier=4770700)
+            config.register_guild(patterns={}, phrases={}, watched_users={}, watchdog_channel_id=None,
+                                  immune_role_ids=[], embed_immune_role_ids=[], max_pattern_cost_ms=10,
+                                  pattern_stats={})
+            config.register_channel(whitelist=[], blacklist=[], autoemoji=[], image_only=False,
+                                    image_limit=1, reset_message_count=LOGS_PER_CHANNEL_USER, image_reset_minutes=5,
+                                    imagelimit_enabled=False, embedlimit_enabled=False, embed_limit=2)
+        self.config = config
 
         self.settings = AutoMod2Settings('automod2', bot)
-        self.channel_user_logs = defaultdict(lambda: deque(maxlen=LOGS_PER_CHANNEL_USER))
 
-        self.server_user_last = defaultdict(dict)
-        self.server_phrase_last = defaultdict(dict)
+        self.image_logs = ImageLimitTracker()
+        self.deletion_queue = DeletionQueue()
+        self.outbox = ReportOutbox()
+        self.reactions = ReactionScheduler()
+
+        self.watchdogs = {}
+        self.user_index = UserDataIndex()
+        self.server_user_last = defaultdict(CooldownMap)
+        self.server_phrase_last = defaultdict(CooldownMap)
+
+        self.pattern_registry = PatternRegistry()
+        self.channel_policies = {}
+
+        # The watchdog runs first so that it still sees messages which a later stage deletes
+        self.message_stages = (
+            ('watchdog', self.mod_message_watchdog),
+            ('rules', self.mod_message),
+            ('images', self.mod_message_images),
+            ('embeds', self.mod_message_embeds),
+            ('autoemoji', self.add_auto_emojis),
+        )
+        self.edit_stages = (
+            ('rules', self.mod_message),
+        )
+        self.stage_timings = defaultdict(lambda: deque(maxlen=1000))
+
+        self.outbox.start(bot.loop)
+        self._image_log_eviction = bot.loop.create_task(self.evict_image_logs())
+        self._rule_stats_flush = bot.loop.create_task(self.flush_rule_stats_loop())
+
+    async def init(self):
+        await self.bot.wait_until_ready()
+        guilds = await self.config.all_guilds()
+        guild_defaults = self.config.defaults[Config.GUILD]
+        policies = {}
+        for cid, channel_data in (await self.config.all_channels()).items():
+            channel = self.bot.get_channel(cid)
+            if channel is None:
+                # Threads aren't always in the client's channel cache
+                channel = next(filter(None, (guild.get_thread(cid) for guild in self.bot.guilds)), None)
+            if channel is None or channel.guild is None:
+                continue
+            guild_data = guilds.get(channel.guild.id, guild_defaults)
+            patterns = self.pattern_registry.lookup(channel.guild.id)
+            if patterns is None:
+                patterns = self.pattern_registry.build(channel.guild.id, guild_data['patterns'])
+            policy = build_channel_policy(channel_data, guild_data, patterns)
+            if policy.applies:
+                policies[cid] = policy
+        self.channel_policies = policies
+        for gid, guild_data in guilds.items():
+            self.watchdogs.setdefault(gid, build_watchdog(guild_data))
+            self.user_index.load_guild(gid, guild_data)
+        self.user_index.loaded = True
+        logger.info("AutoMod: loaded policies for {} channels".format(len(policies)))
+
+    async def cog_unload(self):
+        self._image_log_eviction.cancel()
+        self._rule_stats_flush.cancel()
+        self.outbox.close()
+        self.deletion_queue.close()
+        await self.reactions.close()
+        self.bot.loop.create_task(self.flush_rule_stats())
+
+    async def evict_image_logs(self):
+        while True:
+            await asyncio.sleep(IMAGE_LOG_EVICTION_INTERVAL)
+            try:
+                evicted = self.image_logs.evict_idle(time.time())
+                logger.debug("Evicted {} idle image limit windows".format(evicted))
+            except Exception:
+                logger.exception("Error evicting image limit windows")
+
+    async def flush_rule_stats_loop(self):
+        while True:
+            await asyncio.sleep(RULE_STATS_FLUSH_INTERVAL)
+            try:
+                await self.flush_rule_stats()
+            except Exception:
+                logger.exception("Error flushing rule stats")
+
+    async def flush_rule_stats(self):
+        """Add the in-memory rule counters to the saved totals and reset them."""
+        # Copy both levels, as patterns can be rebuilt or cleared while config writes are awaited
+        for gid, guild_stats in list(self.pattern_registry.stats.items()):
+            pending = {name: stats for name, stats in list(guild_stats.items()) if stats.evaluations}
+            if not pending:
+                continue
+            async with self.config.guild_from_id(gid).pattern_stats() as saved:
+                for name, stats in pending.items():
+                    saved[name] = stats.merged(saved.get(name))
+                    stats.reset()
+
+    async def clear_rule_stats(self, guild, name):
+        self.pattern_registry.stats[guild.id].pop(name, None)
+        async with self.config.guild(guild).pattern_stats() as saved:
+            saved.pop(name, None)
+
+    async def user_data_entries(self, user_id):
+        if not self.user_index.loaded:
+            for gid, guild_data in (await self.config.all_guilds()).items():
+                self.user_index.load_guild(gid, guild_data)
+            self.user_index.loaded = True
+        return self.user_index.lookup(user_id)
 
     async def red_get_data_for_user(self, *, user_id):
         """Get a user's personal data."""
-        watchlisted = 0
-        watchdogs = 0
-        phrases_set = 0
-
-        for gid in await self.config.all_guilds():
-            watched_users = await self.config.guild_from_id(gid).watched_users()
-            if str(user_id) in watched_users:
-                watchlisted += 1
-            for user in watched_users:
-                if watched_users[user]['request_user_id'] == user_id:
-                    watchdogs += 1
-            phrases = await self.config.guild_from_id(gid).phrases()
-            for phrase in phrases:
-                if phrases[phrase]['request_user_id'] == user_id:
-                    phrases_set += 1
+        entries = await self.user_data_entries(user_id)
+        watchlisted = sum(1 for _, kind, _ in entries if kind == 'watched')
+        watchdogs = sum(1 for _, kind, _ in entries if kind == 'watchdog')
+        phrases_set = sum(1 for _, kind, _ in entries if kind == 'phrase')
 
         data = f"Stored data for user with ID {user_id}:\n"
         if watchdogs:
@@ -144,21 +352,22 @@ class AutoMod(commands.Cog):
         so some data deletion requests can only be made by the bot owner and
         Discord itself.  If this is an issue, please contact a bot owner.
         """
-        for gid in await self.config.all_guilds():
-            async with self.config.guild_from_id(gid).phrases() as phrases:
-                for phrase in phrases:
-                    if phrases[phrase]['request_user_id'] == user_id:
-                        phrases[phrase]['request_user_id'] = -1
-            async with self.config.guild_from_id(gid).watched_users() as watched_users:
-                for user in watched_users:
-                    if watched_users[user]['request_user_id'] == user_id:
-                        watched_users[user]['request_user_id'] = -1
-
-        if requester in ('discord_deleted_user', 'owner'):
-            for gid in await self.config.all_guilds():
+        entries = await self.user_data_entries(user_id)
+        for gid, kind, key in entries:
+            if kind == 'phrase':
+                async with self.config.guild_from_id(gid).phrases() as phrases:
+                    if key in phrases and phrases[key]['request_user_id'] == user_id:
+                        phrases[key]['request_user_id'] = -1
+            elif kind == 'watchdog':
                 async with self.config.guild_from_id(gid).watched_users() as watched_users:
-                    if str(user_id) in watched_users:
-                        del watched_users[str(user_id)]
+                    if key in watched_users and watched_users[key]['request_user_id'] == user_id:
+                        watched_users[key]['request_user_id'] = -1
+            elif kind == 'watched' and requester in ('discord_deleted_user', 'owner'):
+                async with self.config.guild_from_id(gid).watched_users() as watched_users:
+                    watched_users.pop(key, None)
+
+        for gid in {gid for gid, _, _ in entries}:
+            self.set_watchdog(gid, await self.config.guild_from_id(gid).all())
 
     @commands.command()
     @checks.mod_or_permissions(manage_guild=True)
@@ -193,8 +402,14 @@ class AutoMod(commands.Cog):
         except Exception as ex:
             await ctx.send(inline(str(ex)))
             return
+        if not (await self.check_pattern_cost(ctx, include_pattern)
+                and await self.check_pattern_cost(ctx, exclude_pattern)):
+            return
         async with self.config.guild(ctx.guild).patterns() as patterns:
             patterns[name] = {'include_pattern': include_pattern, 'exclude_pattern': exclude_pattern, 'uses': 0}
+            await self.clear_rule_stats(ctx.guild, name)
+            self.pattern_registry.build(ctx.guild.id, patterns)
+        await self.refresh_guild_policies(ctx.guild)
         await ctx.tick()
 
     @automod.command()
@@ -210,6 +425,56 @@ class AutoMod(commands.Cog):
                 await ctx.send(f"Rule '{name}' is in use.")
                 return
             del patterns[name]
+            await self.clear_rule_stats(ctx.guild, name)
+            self.pattern_registry.build(ctx.guild.id, patterns)
+        await ctx.tick()
+
+    @automod.command()
+    @commands.guild_only()
+    @checks.mod_or_permissions(manage_guild=True)
+    async def maxpatterncost(self, ctx, milliseconds: float = None):
+        """Set the estimated worst case time (ms) above which new patterns are rejected.
+
+        When a pattern or watchdog phrase is added, it is checked for constructs that can
+        backtrack catastrophically and timed against adversarial text.
+        """
+        if milliseconds is None:
+            current = await self.config.guild(ctx.guild).max_pattern_cost_ms()
+            await ctx.send(inline(f"Patterns are rejected above an estimated {current}ms per message."))
+            return
+        if milliseconds <= 0:
+            await ctx.send("The limit must be positive.")
+            return
+        await self.config.guild(ctx.guild).max_pattern_cost_ms.set(milliseconds)
+        await ctx.tick()
+
+    async def check_pattern_cost(self, ctx, pattern):
+        """Analyse a pattern for catastrophic backtracking, returning True if it may be used."""
+        if not pattern or pattern[0] == pattern[-1] == ':':
+            return True
+        async with ctx.typing():
+            cost = await self.bot.loop.run_in_executor(None, analyse_pattern, pattern, PATTERN_FLAGS)
+        threshold = await self.config.guild(ctx.guild).max_pattern_cost_ms()
+        if cost.worst_case_ms is not None and cost.worst_case_ms > threshold:
+            await ctx.send(box(f"Pattern {pattern} rejected: checking a message may take longer than the"
+                               f" limit of {threshold}ms.\n{cost.describe()}"))
+            return False
+        if cost.issues:
+            await ctx.send(box(f"Warning for pattern {pattern}:\n{cost.describe()}"))
+        return True
+
+    @automod.command()
+    @commands.guild_only()
+    @checks.mod_or_permissions(manage_guild=True)
+    async def enablepattern(self, ctx, *, name):
+        """Re-enable a pattern that was disabled for taking too long to match."""
+        async with self.config.guild(ctx.guild).patterns() as patterns:
+            if name not in patterns:
+                await ctx.send(f"Rule '{name}' is undefined.")
+                return
+            patterns[name]['disabled'] = False
+            self.pattern_registry.build(ctx.guild.id, patterns)
+        await self.refresh_guild_policies(ctx.guild)
         await ctx.tick()
 
     @automod.command()
@@ -227,6 +492,7 @@ class AutoMod(commands.Cog):
                 if name not in whitelist:
                     whitelist.append(name)
                     patterns[name]['uses'] += 1
+        await self.refresh_channel_policy(channel)
         await ctx.tick()
 
     @automod.command()
@@ -244,6 +510,7 @@ class AutoMod(commands.Cog):
                     return
                 whitelist.remove(name)
                 patterns[name]['uses'] -= 1
+        await self.refresh_channel_policy(channel)
         await ctx.tick()
 
     @automod.command()
@@ -261,6 +528,7 @@ class AutoMod(commands.Cog):
                 if name not in blacklist:
                     blacklist.append(name)
                     patterns[name]['uses'] += 1
+        await self.refresh_channel_policy(channel)
         await ctx.tick()
 
     @automod.command()
@@ -278,27 +546,37 @@ class AutoMod(commands.Cog):
                     return
                 blacklist.remove(name)
                 patterns[name]['uses'] -= 1
+        await self.refresh_channel_policy(channel)
         await ctx.tick()
 
     @automod.command(name='list')
     @commands.guild_only()
     @checks.mod_or_permissions(manage_guild=True)
-    async def am2_list(self, ctx):
-        """List the whitelist/blacklist configuration for the current guild."""
+    async def am2_list(self, ctx, channel: Optional[discord.TextChannel] = None, *, rule: str = None):
+        """List the whitelist/blacklist configuration for the current guild.
+
+        Optionally only show one channel, or the channels that use a given rule."""
+        all_channels = await self.config.all_channels()
+        channels = [channel] if channel is not None else ctx.guild.channels
         output = "AutoMod configs\n"
-        for channel in ctx.guild.channels:
-            whitelists = await self.config.channel(channel).whitelist()
-            blacklists = await self.config.channel(channel).blacklist()
-            auto_emojis = await self.config.channel(channel).autoemoji()
-            imagelimit_enabled = await self.config.channel(channel).imagelimit_enabled()
-            image_limit = await self.config.channel(channel).image_limit()
-            il_messages = await self.config.channel(channel).reset_message_count()
-            il_mins = await self.config.channel(channel).image_reset_minutes()
-            embedlimit_enabled = await self.config.channel(channel).embedlimit_enabled()
-            embed_limit = await self.config.channel(channel).embed_limit()
+        for channel in channels:
+            channel_data = all_channels.get(channel.id)
+            if channel_data is None:
+                continue
+            whitelists = channel_data['whitelist']
+            blacklists = channel_data['blacklist']
+            auto_emojis = channel_data['autoemoji']
+            imagelimit_enabled = channel_data['imagelimit_enabled']
+            image_limit = channel_data['image_limit']
+            il_messages = channel_data['reset_message_count']
+            il_mins = channel_data['image_reset_minutes']
+            embedlimit_enabled = channel_data['embedlimit_enabled']
+            embed_limit = channel_data['embed_limit']
 
             if not (whitelists or blacklists or auto_emojis or imagelimit_enabled or embedlimit_enabled):
                 continue
+            if rule is not None and rule not in whitelists and rule not in blacklists:
+                continue
 
             output += f"\n#{channel.name}"
             output += "\n\tWhitelists"
@@ -326,6 +604,186 @@ class AutoMod(commands.Cog):
         for page in pagify(output):
             await ctx.send(box(page))
 
+    @automod.command()
+    @commands.guild_only()
+    @checks.mod_or_permissions(manage_guild=True)
+    async def profile(self, ctx, limit: int = 10):
+        """List the rules in this server that have spent the most time matching messages."""
+        totals = await self.config.guild(ctx.guild).pattern_stats()
+        for name, stats in self.pattern_registry.stats[ctx.guild.id].items():
+            if stats.evaluations:
+                totals[name] = stats.merged(totals.get(name))
+        if not totals:
+            await ctx.send("No rules have been evaluated yet.")
+            return
+
+        tbl = prettytable.PrettyTable(["Rule Name", "Runs", "Matches", "Deletes", "Avg (us)", "Max (ms)", "Total (ms)"])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for name, stats in sorted(totals.items(), key=lambda item: item[1]['total_ms'], reverse=True)[:limit]:
+            tbl.add_row([name, stats['evaluations'], stats['matches'], stats['deletions'],
+                         round(stats['total_ms'] / stats['evaluations'] * 1000, 1) if stats['evaluations'] else 0,
+                         round(stats['max_ms'], 3), round(stats['total_ms'], 1)])
+        for page in pagify(strip_right_multiline(tbl.get_string())):
+            await ctx.send(box(page))
+
+    @automod.command()
+    @checks.is_owner()
+    async def patterncache(self, ctx):
+        """Show compiled pattern cache statistics."""
+        registry = self.pattern_registry
+        await ctx.send(inline('{} guilds cached, {} hits, {} misses'.format(
+            len(registry), registry.hits, registry.misses)))
+
+    @automod.command()
+    @commands.guild_only()
+    @checks.mod_or_permissions(manage_guild=True)
+    async def backtest(self, ctx, channel: Optional[discord.TextChannel], include_pattern,
+                       exclude_pattern='', limit: int = 1000):
+        """See how often a pattern would have matched a channel's recent messages, and at what cost.
+
+        include_pattern can also be the name of an existing pattern. Messages from bots are skipped.
+        Sample matches are only shown if the channel is this one or visible to everyone.
+        """
+        from .backtest import BATCH_SIZE, BacktestResult, evaluate_batch
+        channel = channel or ctx.channel
+        permissions = channel.permissions_for(ctx.author)
+        if channel.guild != ctx.guild or not (permissions.read_messages and permissions.read_message_history):
+            await ctx.send(inline("You can't read the history of that channel."))
+            return
+        rule_set = await self.backtest_rule(ctx, include_pattern, exclude_pattern)
+        if rule_set is None:
+            return
+
+        result = BacktestResult()
+        async with ctx.typing():
+            batch = []
+            async for message in channel.history(limit=limit, before=ctx.message):
+                if message.author.bot:
+                    continue
+                batch.append(message.clean_content)
+                if len(batch) >= BATCH_SIZE:
+                    result.merge(await self.bot.loop.run_in_executor(None, evaluate_batch, rule_set, batch))
+                    batch = []
+            if batch:
+                result.merge(await self.bot.loop.run_in_executor(None, evaluate_batch, rule_set, batch))
+        # Don't copy messages from a private channel into one with a wider audience
+        show_samples = channel == ctx.channel or channel.permissions_for(ctx.guild.default_role).read_messages
+        await self.send_backtest_result(ctx, result, show_samples)
+
+    @automod.command()
+    @checks.is_owner()
+    async def backtestexport(self, ctx, path, include_pattern, exclude_pattern=''):
+        """Backtest a pattern against a message export on the bot host.
+
+        Either a .jsonl file with a {"content": ...} object per line, or a .db/.sqlite
+        file with a `messages` table that has a `content` column.
+        """
+        from .backtest import backtest_export
+        rule_set = await self.backtest_rule(ctx, include_pattern, exclude_pattern)
+        if rule_set is None:
+            return
+        async with ctx.typing():
+            try:
+                result = await self.bot.loop.run_in_executor(None, backtest_export, rule_set, path)
+            except (OSError, ValueError, sqlite3.Error) as ex:
+                await ctx.send(inline("Failed to read export: {}".format(ex)))
+                return
+        await self.send_backtest_result(ctx, result)
+
+    async def backtest_rule(self, ctx, include_pattern, exclude_pattern):
+        from .backtest import make_rule
+        if not exclude_pattern and ctx.guild is not None:
+            existing = (await self.config.guild(ctx.guild).patterns()).get(include_pattern)
+            if existing is not None:
+                include_pattern, exclude_pattern = existing['include_pattern'], existing['exclude_pattern']
+        try:
+            return make_rule(include_pattern, exclude_pattern)
+        except Exception as ex:
+            await ctx.send(inline(str(ex)))
+            return None
+
+    async def send_backtest_result(self, ctx, result, show_samples=True):
+        await ctx.send(box(result.describe()))
+        if result.samples and show_samples:
+            samples = '\n'.join(txt if len(txt) <= 200 else txt[:200] + '...' for txt in result.samples)
+            for page in pagify("Sample matches:\n" + samples):
+                await ctx.send(box(page))
+
+    @automod.group()
+    @checks.is_owner()
+    async def benchmark(self, ctx):
+        """Run synthetic automod benchmarks."""
+
+    @benchmark.command(name='matcher')
+    async def bm_matcher(self, ctx):
+        """Compare per-message rule matching cost at 10/50/200 blacklist rules."""
+        from .benchmark import matcher_benchmark
+        async with ctx.typing():
+            results = await self.bot.loop.run_in_executor(None, matcher_benchmark)
+        tbl = prettytable.PrettyTable(["Rules", "Loop (us/msg)", "RuleSet (us/msg)", "Speedup"])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for count, loop_us, rule_set_us in results:
+            tbl.add_row([count, round(loop_us, 2), round(rule_set_us, 2), '{:.1f}x'.format(loop_us / rule_set_us)])
+        await ctx.send(box(strip_right_multiline(tbl.get_string())))
+
+    @benchmark.command(name='replay')
+    async def bm_replay(self, ctx, path: str = None):
+        """Replay messages through the whole automod pipeline at 10/50/200 blacklist rules.
+
+        Uses a generated corpus, or a JSONL file on the bot host with one
+        {"content": ..., "author_id": ..., "attachments": n, "embeds": n} object per line.
+        """
+        from .benchmark import load_replay_corpus, replay_benchmark
+        records = None
+        if path is not None:
+            try:
+                records = load_replay_corpus(path)
+            except (OSError, ValueError) as ex:
+                await ctx.send(inline("Failed to read corpus: {}".format(ex)))
+                return
+        async with ctx.typing():
+            results = await self.bot.loop.run_in_executor(None, lambda: replay_benchmark(records=records))
+        tbl = prettytable.PrettyTable(["Rules", "Stage", "msg/s", "p50 (us)", "p99 (us)"])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for count, stage, throughput, p50, p99 in results:
+            tbl.add_row([count, stage, int(throughput),
+                         '' if p50 is None else round(p50, 1), '' if p99 is None else round(p99, 1)])
+        for page in pagify(strip_right_multiline(tbl.get_string())):
+            await ctx.send(box(page))
+
+    @automod.command()
+    @checks.is_owner()
+    async def outbox(self, ctx):
+        """Show the state of the moderation DM and watchdog post queue, and of the reaction queue."""
+        outbox = self.outbox
+        await ctx.send(inline('{} queued, {} sent, {} failed, {} merged, {} dropped'.format(
+            outbox.depth, outbox.sent, outbox.failed, outbox.coalesced, outbox.dropped)))
+        await ctx.send(inline('Reactions: {} queued, {} dropped'.format(self.reactions.depth, self.reactions.dropped)))
+
+    @automod.command()
+    @checks.is_owner()
+    async def timings(self, ctx):
+        """Show per-stage message processing times."""
+        tbl = prettytable.PrettyTable(["Stage", "Runs", "Avg (ms)", "p99 (ms)", "Max (ms)"])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for name, _ in self.message_stages:
+            samples = sorted(self.stage_timings[name])
+            if not samples:
+                continue
+            tbl.add_row([name, len(samples),
+                         round(sum(samples) / len(samples) * 1000, 3),
+                         round(samples[int(len(samples) * .99)] * 1000, 3),
+                         round(samples[-1] * 1000, 3)])
+        await ctx.send(box(strip_right_multiline(tbl.get_string())))
+
     @automod.group()
     @commands.guild_only()
     @checks.mod_or_permissions(manage_guild=True)
@@ -340,6 +798,7 @@ class AutoMod(commands.Cog):
         within the the lookback window, all those messages are deleted.
         """
         await self.config.channel(channel or ctx.channel).image_limit.set(limit)
+        await self.refresh_channel_policy(channel or ctx.channel)
         await ctx.tick()
 
     @imagelimit.command(name='messages')
@@ -353,6 +812,7 @@ class AutoMod(commands.Cog):
             await ctx.send(f"`count` is out of bounds.  It must be between 1 and {LOGS_PER_CHANNEL_USER} (inclusive).")
             return
         await self.config.channel(channel or ctx.channel).reset_message_count.set(count)
+        await self.refresh_channel_policy(channel or ctx.channel)
         await ctx.tick()
 
     @imagelimit.command(name='minutes')
@@ -364,6 +824,7 @@ class AutoMod(commands.Cog):
         if minutes <= 0:
             minutes = -1
         await self.config.channel(channel or ctx.channel).image_reset_minutes.set(minutes)
+        await self.refresh_channel_policy(channel or ctx.channel)
         if minutes == -1:
             await ctx.send("The time interval for this channel has been disabled.")
         else:
@@ -373,6 +834,7 @@ class AutoMod(commands.Cog):
     async def il_enable(self, ctx, channel: Optional[discord.TextChannel], enabled: bool = True):
         """Enable or disable imagelimit"""
         await self.config.channel(channel or ctx.channel).imagelimit_enabled.set(enabled)
+        await self.refresh_channel_policy(channel or ctx.channel)
         await ctx.tick()
 
     @imagelimit.group(name='immunerole')
@@ -386,6 +848,7 @@ class AutoMod(commands.Cog):
             async with self.config.guild(ctx.guild).immune_role_ids() as old_roles:
                 if role.id not in old_roles:
                     old_roles.append(role.id)
+        await self.refresh_guild_policies(ctx.guild)
         await ctx.tick()
 
     @immunerole.command(name='remove', aliases=["rm", "delete", "del"])
@@ -395,6 +858,7 @@ class AutoMod(commands.Cog):
             async with self.config.guild(ctx.guild).immune_role_ids() as old_roles:
                 if role.id in old_roles:
                     old_roles.remove(role.id)
+        await self.refresh_guild_policies(ctx.guild)
         await ctx.tick()
 
     @immunerole.command(name='list')
@@ -414,12 +878,14 @@ class AutoMod(commands.Cog):
     async def el_max(self, ctx, channel: Optional[discord.TextChannel], limit: int):
         """Set the max number of embeds that can be attached to a message"""
         await self.config.channel(channel or ctx.channel).embed_limit.set(limit)
+        await self.refresh_channel_policy(channel or ctx.channel)
         await ctx.tick()
     
     @embedlimit.command(name='enable')
     async def el_enable(self, ctx, channel: Optional[discord.TextChannel], enabled: bool = True):
         """Enable or disable embedlimit"""
         await self.config.channel(channel or ctx.channel).embedlimit_enabled.set(enabled)
+        await self.refresh_channel_policy(channel or ctx.channel)
         await ctx.tick()
         
     @embedlimit.group(name='immunerole')
@@ -433,6 +899,7 @@ class AutoMod(commands.Cog):
             async with self.config.guild(ctx.guild).embed_immune_role_ids() as old_roles:
                 if role.id not in old_roles:
                     old_roles.append(role.id)
+        await self.refresh_guild_policies(ctx.guild)
         await ctx.tick()
 
     @embedimmunerole.command(name='remove', aliases=["rm", "delete", "del"])
@@ -442,6 +909,7 @@ class AutoMod(commands.Cog):
             async with self.config.guild(ctx.guild).embed_immune_role_ids() as old_roles:
                 if role.id in old_roles:
                     old_roles.remove(role.id)
+        await self.refresh_guild_policies(ctx.guild)
         await ctx.tick()
 
     @embedimmunerole.command(name='list')
@@ -451,21 +919,16 @@ class AutoMod(commands.Cog):
         await ctx.send('\n'.join(role.mention for rid in roles if (role := ctx.guild.get_role(rid))),
                        allowed_mentions=discord.AllowedMentions(roles=False))
 
-    @commands.Cog.listener('on_message')
-    async def mod_message_embeds(self, message):
-        if message.author.id == self.bot.user.id or isinstance(message.channel, (discord.DMChannel, discord.Thread)):
-            return
-        if not isinstance(message.author, discord.Member):
+    async def mod_message_embeds(self, msg_ctx):
+        policy = msg_ctx.policy
+        if policy is None or not policy.embedlimit_enabled:
             return
-        if message.channel.permissions_for(message.author).manage_messages:
+        if isinstance(msg_ctx.message.channel, discord.Thread) or not msg_ctx.moderatable:
             return
-        if not await self.config.channel(message.channel).embedlimit_enabled():
+        message = msg_ctx.message
+        if any(role.id in policy.embed_immune_role_ids for role in message.author.roles):
             return
-        immune_rids = await self.config.guild(message.guild).embed_immune_role_ids()
-        if any(role.id in immune_rids for role in message.author.roles):
-            return
-        embed_limit = await self.config.channel(message.channel).embed_limit()
-        if len(message.embeds) <= embed_limit:
+        if len(message.embeds) <= policy.embed_limit:
             return
         
         try:
@@ -482,100 +945,154 @@ class AutoMod(commands.Cog):
         """Only allow images to be sent in a channel."""
         await asyncio.sleep(.5)  # To make sure it doesn't flag the command
         await self.config.channel(channel or ctx.channel).image_only.set(enabled)
+        await self.refresh_channel_policy(channel or ctx.channel)
         await ctx.tick()
 
-    @commands.Cog.listener('on_message')
-    async def mod_message_images(self, message):
-        if message.author.id == self.bot.user.id or isinstance(message.channel, (discord.DMChannel, discord.Thread)):
+    async def mod_message_images(self, msg_ctx):
+        policy = msg_ctx.policy
+        if policy is None or not policy.imagelimit_enabled:
             return
-        if not isinstance(message.author, discord.Member):
+        if isinstance(msg_ctx.message.channel, discord.Thread) or not msg_ctx.moderatable:
             return
-        if message.channel.permissions_for(message.author).manage_messages:
-            return
-        if not await self.config.channel(message.channel).imagelimit_enabled():
-            return
-        immune_rids = await self.config.guild(message.guild).immune_role_ids()
-        if any(role.id in immune_rids for role in message.author.roles):
+        message = msg_ctx.message
+        if any(role.id in policy.immune_role_ids for role in message.author.roles):
             return
 
-        if await self.config.channel(message.channel).image_only():
+        if policy.image_only:
             if len(message.embeds) or len(message.attachments):
                 return
             msg = f"Your message in {message.channel.name} was deleted for not containing an image"
-            await self.deleteAndReport(message, msg)
+            msg_ctx.deleted = await self.deleteAndReport(message, msg)
             return
 
-        seconds = await self.config.channel(message.channel).image_reset_minutes() * 60
-        message_count = await self.config.channel(message.channel).reset_message_count()
-        image_limit = await self.config.channel(message.channel).image_limit()
-
-        key = (message.channel.id, message.author.id)
-        self.channel_user_logs[key].append(message)
-
-        user_logs = list(self.channel_user_logs[key])[-message_count:]
-        count = 0
-        for m in user_logs:
-            if seconds == -60 or (datetime.now(UTC) - m.created_at).total_seconds() < seconds:
-                count += linked_img_count(m)
-        if count == 0:
-            self.channel_user_logs[key].clear()
-        if count <= image_limit:
+        max_age = policy.image_reset_minutes * 60 if policy.image_reset_minutes > 0 else None
+        window = self.image_logs.record(message.channel.id, message.author.id,
+                                        ImageLogEntry(message.id, message.created_at.timestamp(),
+                                                      linked_img_count(message)),
+                                        policy.reset_message_count, max_age, time.time())
+        if window.total <= policy.image_limit:
             return
 
-        for m in user_logs:
-            if seconds == -60 or (datetime.now(UTC) - m.created_at).total_seconds() < seconds:
-                if linked_img_count(m) > 0:
-                    try:
-                        await m.delete()
-                    except Exception:
-                        pass
+        to_delete = [entry.message_id for entry in window.entries if entry.image_count > 0]
+        window.clear()
+        # Deletions are batched in the background; the later stages don't need to wait for them
+        self.deletion_queue.enqueue(message.channel, to_delete)
+        msg_ctx.deleted = message.id in to_delete
 
-        self.channel_user_logs[key].clear()
         msg = f"{message.author.mention} Upload multiple images to an imgbb album #endimagespam"
         await message.channel.send(msg)
 
-    @commands.Cog.listener('on_message_edit')
-    async def mod_message_edit(self, before, after):
-        await self.mod_message(after)
-
     @commands.Cog.listener('on_message')
-    async def mod_message(self, message):
-        if isinstance(message.channel, discord.abc.PrivateChannel):
+    async def on_message_pipeline(self, message):
+        if isinstance(message.channel, discord.abc.PrivateChannel) or message.author.id == self.bot.user.id:
             return
-        if message.author.bot or not isinstance(message.author, discord.Member):
-            return
-        if message.channel.permissions_for(message.author).manage_messages:
+        msg_ctx = MessageContext(message, self.channel_policies.get(message.channel.id))
+        await self.run_pipeline(msg_ctx, self.message_stages)
+
+    @commands.Cog.listener('on_message_edit')
+    async def mod_message_edit(self, before, after):
+        if isinstance(after.channel, discord.abc.PrivateChannel):
             return
+        msg_ctx = MessageContext(after, self.channel_policies.get(after.channel.id))
+        await self.run_pipeline(msg_ctx, self.edit_stages)
 
-        whitelists = await self.config.channel(message.channel).whitelist()
-        blacklists = await self.config.channel(message.channel).blacklist()
+    async def run_pipeline(self, msg_ctx, stages, timings=None):
+        """Run each stage in order, stopping once a stage has deleted the message.
 
-        msg_content = message.clean_content
-        for name in blacklists:
-            pattern = (await self.config.guild(message.guild).patterns())[name]
-            include_pattern = pattern['include_pattern']
-            exclude_pattern = pattern['exclude_pattern']
+        Stage durations are appended to `timings` ({stage name: list}), or stage_timings by default.
+        """
+        if timings is None:
+            timings = self.stage_timings
+        for name, stage in stages:
+            if msg_ctx.deleted:
+                return
+            before_time = timeit.default_timer()
+            try:
+                await stage(msg_ctx)
+            except Exception:
+                logger.exception("Error in automod stage {}".format(name))
+            timings[name].append(timeit.default_timer() - before_time)
+
+    async def mod_message(self, msg_ctx):
+        policy = msg_ctx.policy
+        if policy is None or not (policy.whitelist or policy.blacklist):
+            return
+        if msg_ctx.message.author.bot or not msg_ctx.moderatable:
+            return
 
-            if not matchesIncludeExclude(include_pattern, exclude_pattern, msg_content):
-                continue
+        message = msg_ctx.message
+        msg_content = msg_ctx.clean_content
+        # A rule which times out is skipped, so the others still get to judge the message,
+        # and is disabled afterwards
+        blacklist_timeouts, whitelist_timeouts = [], []
+        rule = policy.blacklist.first_match(msg_content, timed_out=blacklist_timeouts)
+        # The whitelist only matters for messages the blacklist let through
+        whitelisted = (rule is not None or not policy.whitelist
+                       or policy.whitelist.first_match(msg_content, timed_out=whitelist_timeouts) is not None)
+
+        if rule is not None:
+            rule.stats.deletions += 1
+            msg_ctx.deleted = await self.deleteAndReport(
+                message, box(f"Your message in {message.channel.name} was deleted for violating"
+                             f" the following policy: {rule.name}\nMessage content: {msg_content}"))
+        elif not whitelisted and not whitelist_timeouts:
+            failed_whitelists = [rule.name for rule in policy.whitelist]
+            msg_ctx.deleted = await self.deleteAndReport(message, box(f"Your message in {message.channel.name} was deleted for violating"
+                                                    f" the following policy: {','.join(failed_whitelists)}"
+                                                    f"\nMessage content: {msg_content}"))
 
-            await self.deleteAndReport(message,
-                                       box(f"Your message in {message.channel.name} was deleted for violating"
-                                           f" the following policy: {name}\nMessage content: {msg_content}"))
+        for timed_out_rule in blacklist_timeouts + whitelist_timeouts:
+            await self.disable_pattern(message.guild, timed_out_rule.name, message.channel)
 
-        if whitelists:
-            failed_whitelists = []
-            for name in whitelists:
-                pattern = (await self.config.guild(message.guild).patterns())[name]
-                include_pattern = pattern['include_pattern']
-                exclude_pattern = pattern['exclude_pattern']
+    async def disable_pattern(self, guild, name, channel):
+        """Disable a pattern which exceeded the matching time budget and tell the watchdog channel."""
+        async with self.config.guild(guild).patterns() as patterns:
+            if name not in patterns or patterns[name].get('disabled'):
+                return
+            patterns[name]['disabled'] = True
+            self.pattern_registry.build(guild.id, patterns)
+        await self.refresh_guild_policies(guild)
+        logger.warning("Disabled pattern {} in guild {} after timing out".format(name, guild.id))
 
-                if matchesIncludeExclude(include_pattern, exclude_pattern, msg_content):
-                    return
-                failed_whitelists.append(name)
-            await self.deleteAndReport(message, box(f"Your message in {message.channel.name} was deleted for violating"
-                                                    f" the following policy: {','.join(failed_whitelists)}"
-                                                    f"\nMessage content: {msg_content}"))
+        watchdog_channel_id = await self.config.guild(guild).watchdog_channel_id()
+        if watchdog_channel_id:
+            await self._watchdog_show(watchdog_channel_id,
+                                      "**AutoMod:** pattern `{}` took longer than {}ms to check a message in {}"
+                                      " and has been disabled. Fix it and re-add it with addpattern, or use"
+                                      " enablepattern to turn it back on.".format(
+                                          name, int(PATTERN_TIMEOUT * 1000), channel.mention))
+
+    async def get_compiled_patterns(self, guild):
+        patterns = self.pattern_registry.lookup(guild.id)
+        if patterns is None:
+            patterns = self.pattern_registry.build(guild.id, await self.config.guild(guild).patterns())
+        return patterns
+
+    async def refresh_channel_policy(self, channel):
+        """Rebuild the policy snapshot for a single channel and swap it in."""
+        policy = build_channel_policy(await self.config.channel(channel).all(),
+                                      await self.config.guild(channel.guild).all(),
+                                      await self.get_compiled_patterns(channel.guild))
+        policies = dict(self.channel_policies)
+        if policy.applies:
+            policies[channel.id] = policy
+        else:
+            policies.pop(channel.id, None)
+        self.channel_policies = policies
+
+    async def refresh_guild_policies(self, guild):
+        """Rebuild the policy snapshots for every configured channel in a guild."""
+        guild_data = await self.config.guild(guild).all()
+        patterns = await self.get_compiled_patterns(guild)
+        policies = {cid: policy for cid, policy in self.channel_policies.items()
+                    if guild.get_channel_or_thread(cid) is None}
+        for cid, channel_data in (await self.config.all_channels()).items():
+            if guild.get_channel_or_thread(cid) is None:
+                continue
+            policy = build_channel_policy(channel_data, guild_data, patterns)
+            if policy.applies:
+                policies[cid] = policy
+        self.channel_policies = policies
 
     @automod.command()
     @commands.guild_only()
@@ -586,20 +1103,20 @@ class AutoMod(commands.Cog):
         Add `[noemoji]` to a message to suppress emoji addition."""
         # TODO: Validate emoji
         await self.config.channel(ctx.channel).autoemoji.set(emoji)
+        await self.refresh_channel_policy(ctx.channel)
         if not emoji:
             await ctx.send("Auto emojis cleared")
         else:
             await ctx.send("Autoemojis is configured for this channel.")
 
-    @commands.Cog.listener('on_message')
-    async def add_auto_emojis(self, message):
-        if message.author.id == self.bot.user.id or isinstance(message.channel, discord.abc.PrivateChannel):
+    async def add_auto_emojis(self, msg_ctx):
+        policy = msg_ctx.policy
+        if policy is None or not policy.autoemoji:
             return
-        emoji_list = await self.config.channel(message.channel).autoemoji()
+        message = msg_ctx.message
         if '[noemojis]' in message.content:
             return
-        for emoji in emoji_list:
-            await message.add_reaction(emoji)
+        self.reactions.add(message, policy.autoemoji)
 
     @commands.group()
     @commands.guild_only()
@@ -648,6 +1165,8 @@ class AutoMod(commands.Cog):
             if phrase_cooldown:
                 msg += "\n{} -> {}\n\tcooldown {}\n\tby {}".format(
                     name, phrase, phrase_cooldown, request_user_txt)
+                if phrase_settings.get('disabled'):
+                    msg += "\n\tdisabled (timed out)"
 
         for page in pagify(msg):
             await ctx.send(box(page))
@@ -684,6 +1203,7 @@ class AutoMod(commands.Cog):
                         'reason': reason,
                     }
                     await ctx.send(f"Watchdog set on {user.name} with cooldown of {cooldown} seconds")
+            await self.refresh_watchdog(ctx.guild)
 
     @watchdog.command()
     @commands.guild_only()
@@ -697,18 +1217,22 @@ class AutoMod(commands.Cog):
         Name is descriptive. Set a cooldown of 0 to clear.
         """
         server_id = ctx.guild.id
-        async with self.config.guild(ctx.guild).phrases() as phrases:
-            if cooldown == 0:
-                if phrase in phrases:
-                    del phrases[phrase]
-                await ctx.send(f"Watchdog phrase cleared for {name}")
-                return
+        if cooldown == 0:
+            async with self.config.guild(ctx.guild).phrases() as phrases:
+                if name in phrases:
+                    del phrases[name]
+            await self.refresh_watchdog(ctx.guild)
+            await ctx.send(f"Watchdog phrase cleared for {name}")
+            return
 
+        async with self.config.guild(ctx.guild).phrases() as phrases:
             try:
                 re.compile(phrase)
             except Exception as ex:
                 await ctx.send(inline(str(ex)))
                 return
+            if not await self.check_pattern_cost(ctx, phrase):
+                return
 
             if cooldown < 300:
                 await ctx.send("Overriding cooldown to minimum (300 seconds)")
@@ -718,8 +1242,9 @@ class AutoMod(commands.Cog):
                 'cooldown': cooldown,
                 'phrase': phrase,
             }
-            self.server_phrase_last[server_id][name] = None
-            await ctx.send(f"Watchdog named {name} set on {phrase} with cooldown of {cooldown} seconds")
+            self.server_phrase_last[server_id].clear(name)
+        await self.refresh_watchdog(ctx.guild)
+        await ctx.send(f"Watchdog named {name} set on {phrase} with cooldown of {cooldown} seconds")
 
     @watchdog.command()
     @commands.guild_only()
@@ -728,24 +1253,32 @@ class AutoMod(commands.Cog):
         """Set the announcement channel."""
         channel = channel or ctx.channel
         await self.config.guild(ctx.guild).watchdog_channel_id.set(channel.id)
+        await self.refresh_watchdog(ctx.guild)
         await ctx.tick()
 
-    @commands.Cog.listener('on_message')
-    async def mod_message_watchdog(self, message):
-        if message.author.id == self.bot.user.id or isinstance(message.channel, discord.abc.PrivateChannel):
+    async def refresh_watchdog(self, guild):
+        """Rebuild the watchdog snapshot for a guild after its watchdog config changed."""
+        self.set_watchdog(guild.id, await self.config.guild(guild).all())
+
+    def set_watchdog(self, guild_id, guild_data):
+        self.watchdogs[guild_id] = build_watchdog(guild_data)
+        self.user_index.update_guild(guild_id, guild_data)
+
+    async def mod_message_watchdog(self, msg_ctx):
+        message = msg_ctx.message
+        watchdog = self.watchdogs.get(message.guild.id)
+        if watchdog is None:
+            await self.refresh_watchdog(message.guild)
+            watchdog = self.watchdogs[message.guild.id]
+        if watchdog.channel_id is None:
             return
-        if await self.config.guild(message.guild).watchdog_channel_id() is None:
-            return
-
-        await self.mod_message_watchdog_user(message)
-        await self.mod_message_watchdog_phrase(message)
 
-    async def mod_message_watchdog_user(self, message):
-        user_id = message.author.id
-        server_id = message.guild.id
-        watchdog_channel_id = await self.config.guild(message.guild).watchdog_channel_id()
-        user_settings = (await self.config.guild(message.guild).watched_users()).get(str(message.author.id))
+        await self.mod_message_watchdog_user(msg_ctx, watchdog)
+        await self.mod_message_watchdog_phrase(msg_ctx, watchdog)
 
+    async def mod_message_watchdog_user(self, msg_ctx, watchdog):
+        message = msg_ctx.message
+        user_settings = watchdog.users.get(message.author.id)
         if user_settings is None:
             return
 
@@ -753,72 +1286,78 @@ class AutoMod(commands.Cog):
         if cooldown <= 0:
             return
 
+        # Users are reported when they speak after being quiet for the cooldown
+        now = time.time()
+        last_spoke = self.server_user_last[message.guild.id]
+        report = last_spoke.ready(message.author.id, now)
+        last_spoke.touch(message.author.id, now, cooldown)
+        if not report:
+            return
+
         request_user_id = user_settings['request_user_id']
         reason = user_settings['reason'] or 'no reason'
 
         request_user = message.guild.get_member(request_user_id)
         request_user_txt = request_user.mention if request_user else '???'
 
-        now = datetime.utcnow()
-        last_spoke_at = self.server_user_last[server_id].get(message.author.id)
-        self.server_user_last[server_id][message.author.id] = now
-        time_since = (now - last_spoke_at).total_seconds() if last_spoke_at else 9999
-
-        report = time_since > cooldown
-        if not report:
-            return
-
         output_msg = "**Watchdog:** {} spoke in {} ({} monitored because [{}])\n{}".format(
             message.author.mention, message.channel.mention,
-            request_user_txt, reason, box(message.clean_content))
-        await self._watchdog_show(watchdog_channel_id, output_msg)
+            request_user_txt, reason, box(msg_ctx.clean_content))
+        await self._watchdog_show(watchdog.channel_id, output_msg)
 
-    async def mod_message_watchdog_phrase(self, message):
-        server_id = message.guild.id
-        watchdog_channel_id = await self.config.guild(message.guild).watchdog_channel_id()
-
-        for name, phrase_settings in (await self.config.guild(message.guild).phrases()).items():
-            cooldown = phrase_settings['cooldown']
-            request_user_id = phrase_settings['request_user_id']
-            phrase = phrase_settings['phrase']
+    async def mod_message_watchdog_phrase(self, msg_ctx, watchdog):
+        message = msg_ctx.message
+        phrase_last = self.server_phrase_last[message.guild.id]
+        now = time.time()
 
-            if cooldown <= 0:
+        for phrase in watchdog.phrases:
+            if not phrase_last.ready(phrase.name, now):
                 continue
 
-            now = datetime.utcnow()
-            last_spoke_at = self.server_phrase_last[server_id].get(name)
-            time_since = (now - last_spoke_at).total_seconds() if last_spoke_at else 9999
-
-            report = time_since > cooldown
-            if not report:
+            try:
+                matched = timed_match(phrase.regex, msg_ctx.clean_content)
+            except TimeoutError:
+                await self.disable_phrase(message.guild, phrase.name, message.channel)
                 continue
-
-            p = re.compile(phrase, re.IGNORECASE | re.MULTILINE | re.DOTALL)
-            if p.match(message.clean_content):
-                self.server_phrase_last[server_id][name] = now
+            if matched:
+                phrase_last.touch(phrase.name, now, phrase.cooldown)
                 output_msg = "**Watchdog:** {} spoke in {} `(rule [{}] matched phrase [{}])`\n{}".format(
                     message.author.mention, message.channel.mention,
-                    name, phrase, box(message.clean_content))
-                await self._watchdog_show(watchdog_channel_id, output_msg)
+                    phrase.name, phrase.phrase, box(msg_ctx.clean_content))
+                await self._watchdog_show(watchdog.channel_id, output_msg)
                 return
 
+    async def disable_phrase(self, guild, name, channel):
+        """Disable a watchdog phrase which exceeded the matching time budget."""
+        async with self.config.guild(guild).phrases() as phrases:
+            if name not in phrases or phrases[name].get('disabled'):
+                return
+            phrases[name]['disabled'] = True
+        await self.refresh_watchdog(guild)
+        logger.warning("Disabled watchdog phrase {} in guild {} after timing out".format(name, guild.id))
+
+        watchdog_channel_id = await self.config.guild(guild).watchdog_channel_id()
+        await self._watchdog_show(watchdog_channel_id,
+                                  "**Watchdog:** phrase `{}` took longer than {}ms to check a message in {}"
+                                  " and has been disabled. Set it again to re-enable it.".format(
+                                      name, int(PATTERN_TIMEOUT * 1000), channel.mention))
+
     async def _watchdog_show(self, watchdog_channel_id, output_msg):
-        try:
-            watchdog_channel = self.bot.get_channel(watchdog_channel_id)
-            await watchdog_channel.send(output_msg)
-        except Exception as ex:
-            logger.exception("Failed to watchdog")
+        watchdog_channel = self.bot.get_channel(watchdog_channel_id)
+        if watchdog_channel is None:
+            logger.warning("Failed to watchdog: channel {} not found".format(watchdog_channel_id))
+            return
+        self.outbox.send(watchdog_channel, output_msg)
 
     async def deleteAndReport(self, delete_msg, outgoing_msg):
         try:
             await delete_msg.delete()
-            try:
-                await delete_msg.author.send(outgoing_msg)
-            except discord.Forbidden:
-                pass
+            self.outbox.send(delete_msg.author, outgoing_msg, coalesce=True)
         except Exception as e:
             logger.exception("Failure while deleting message from {}, tried to send : {}".format(
                 delete_msg.author.name, outgoing_msg))
+            return False
+        return True
 
     def patternsToTableText(self, patterns):
         tbl = prettytable.PrettyTable(["Rule Name", "Include regex", "Exclude regex"])
@@ -827,7 +1366,8 @@ class AutoMod(commands.Cog):
         tbl.align = 'l'
 
         for name in patterns:
-            tbl.add_row([name, patterns[name]['include_pattern'], patterns[name]['exclude_pattern']])
+            display_name = name + ' (disabled)' if patterns[name].get('disabled') else name
+            tbl.add_row([display_name, patterns[name]['include_pattern'], patterns[name]['exclude_pattern']])
 
         return strip_right_multiline(tbl.get_string())
 
@@ -858,26 +1398,432 @@ CUSTOM_PATTERNS = {
 }
 
 
-def matchesIncludeExclude(include_pattern, exclude_pattern, txt):
-    if matchesPattern(include_pattern, txt):
-        return not matchesPattern(exclude_pattern, txt)
-    return False
+PATTERN_FLAGS = re.IGNORECASE | re.MULTILINE | re.DOTALL
+MIN_LITERAL_LENGTH = 3
+# Rule sets with fewer distinct literals than this check them with plain substring tests
+MIN_SCANNER_LITERALS = 16
 
+# Seconds a single user supplied regex may run against a message before it is disabled.
+# Only enforced when the regex module is installed; the stdlib re has no timeout support.
+PATTERN_TIMEOUT = .05
 
-def matchesPattern(pattern, txt):
-    if not len(pattern):
-        return False
 
+class PatternTimeoutError(Exception):
+    def __init__(self, rule):
+        super().__init__("Pattern {} timed out".format(rule.name))
+        self.rule = rule
+
+
+def timed_match(regex, txt, concurrent=False):
+    """Match with the regex module's timeout.  Pass concurrent=True off the event loop to
+    release the GIL while matching."""
+    if re.__name__ == 'regex':
+        return regex.match(txt, timeout=PATTERN_TIMEOUT, concurrent=concurrent)
+    return regex.match(txt)
+
+
+def required_literal(pattern):
+    """Find the longest run of literal characters at the top level of a pattern.
+
+    Top level items of a parsed pattern all have to match in sequence, so a run of
+    consecutive literals there must appear verbatim in any matching text.
+    """
+    if '[:' in pattern or '[[' in pattern:
+        # POSIX classes and nested sets, which sre_parse reads differently from the regex module
+        return None
     try:
-        if pattern[0] == pattern[-1] == ':':
-            check_method = CUSTOM_PATTERNS.get(pattern[1:-1])
-            if check_method:
-                return check_method(txt)
+        with warnings.catch_warnings():
+            # sre_parse warns "Possible nested set" for set syntax it may not read as regex does
+            warnings.simplefilter('error', FutureWarning)
+            parsed = sre_parse.parse(pattern, sre_constants.SRE_FLAG_IGNORECASE)
     except Exception:
-        return False
+        # Syntax specific to the regex module
+        return None
+
+    best = current = ''
+    for op, av in parsed:
+        char = chr(av) if op is sre_constants.LITERAL else None
+        if char is not None and char in '{}':
+            # Probably a fuzzy matching constraint, which only the regex module understands
+            return None
+        if char is None or not char.isascii():
+            current = ''
+            continue
+        current += char.lower()
+        if len(current) > len(best):
+            best = current
+    return best if len(best) >= MIN_LITERAL_LENGTH else None
+
+
+class CompiledPattern:
+    """A single include or exclude pattern, compiled once and reused for every message."""
+    __slots__ = ('source', 'regex', 'custom')
+
+    def __init__(self, source):
+        self.source = source
+        self.regex = None
+        self.custom = None
+
+        if not len(source):
+            return
+        if source[0] == source[-1] == ':':
+            self.custom = CUSTOM_PATTERNS.get(source[1:-1])
+            if self.custom:
+                return
+        self.regex = re.compile(source, PATTERN_FLAGS)
+
+    @property
+    def required_literal(self):
+        """Lowercased ASCII text that must appear in any message this pattern matches, if any."""
+        if self.regex is None:
+            return None
+        return required_literal(self.source)
+
+    def match(self, txt, concurrent=False):
+        if self.custom is not None:
+            try:
+                return self.custom(txt)
+            except Exception:
+                return False
+        if self.regex is None:
+            return False
+        return timed_match(self.regex, txt, concurrent)
+
+
+class PatternRegistry:
+    """Per-guild cache of compiled patterns, keyed by pattern name.
+
+    Entries are only rebuilt when the guild's `patterns` config changes.
+    """
+
+    def __init__(self):
+        self._guilds = {}
+        self.stats = defaultdict(dict)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._guilds)
+
+    def lookup(self, guild_id):
+        patterns = self._guilds.get(guild_id)
+        if patterns is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return patterns
+
+    def build(self, guild_id, patterns):
+        compiled = {}
+        guild_stats = self.stats[guild_id]
+        for name, pattern in patterns.items():
+            if pattern.get('disabled'):
+                continue
+            try:
+                stats = guild_stats.get(name)
+                if stats is None:
+                    stats = guild_stats[name] = RuleStats()
+                compiled[name] = (CompiledPattern(pattern['include_pattern']),
+                                  CompiledPattern(pattern['exclude_pattern']),
+                                  stats)
+            except Exception:
+                logger.exception("Failed to compile pattern {} in guild {}".format(name, guild_id))
+        self._guilds[guild_id] = compiled
+        return compiled
+
+    def invalidate(self, guild_id):
+        self._guilds.pop(guild_id, None)
+
+
+class RuleStats:
+    """Counters for one pattern since they were last flushed to config."""
+    __slots__ = ('evaluations', 'matches', 'deletions', 'total_time', 'max_time')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.evaluations = 0
+        self.matches = 0
+        self.deletions = 0
+        self.total_time = 0.
+        self.max_time = 0.
+
+    def record(self, elapsed, matched):
+        self.evaluations += 1
+        self.matches += matched
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+    def merged(self, saved=None):
+        """These counters added to a saved totals dict, as a new dict."""
+        saved = saved or {}
+        return {
+            'evaluations': saved.get('evaluations', 0) + self.evaluations,
+            'matches': saved.get('matches', 0) + self.matches,
+            'deletions': saved.get('deletions', 0) + self.deletions,
+            'total_ms': saved.get('total_ms', 0) + self.total_time * 1000,
+            'max_ms': max(saved.get('max_ms', 0), self.max_time * 1000),
+        }
+
+
+class AutoModRule(NamedTuple):
+    name: str
+    include: CompiledPattern
+    exclude: CompiledPattern
+    stats: RuleStats
+
+
+def literal_trie_pattern(literals):
+    """A regex alternation of literals with common prefixes factored out, longest first."""
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [stdlib_re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        # Try longer continuations before ending here, so each position reports its longest literal
+        body = branches[0] if len(branches) == 1 else '(?:{})'.format('|'.join(branches))
+        return '(?:{})?'.format(body) if '' in node else body
+
+    return build(trie)
+
+
+class RuleSet:
+    """An ordered group of rules evaluated together against each message.
+
+    Most rules require some literal text (e.g. `.*\bbadword\b.*`). Those literals are
+    extracted once and combined into one scanner, which finds every literal present in a
+    message in a single pass; a rule's regexes only run if its literal occurred.
+    Exclude patterns only run for rules whose include pattern hit.
+    """
+    __slots__ = ('rules', 'literals', '_scanner', '_covered', '_unfiltered')
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self.literals = tuple(rule.include.required_literal for rule in self.rules)
+        self._unfiltered = frozenset(idx for idx, literal in enumerate(self.literals) if literal is None)
+
+        distinct = set(filter(None, self.literals))
+        self._scanner = self._covered = None
+        if len(distinct) >= MIN_SCANNER_LITERALS:
+            # A zero width lookahead reports the longest literal starting at each position.
+            # Any shorter one starting there is a prefix of it, so each literal found stands
+            # for the rules of all its prefixes.
+            self._scanner = stdlib_re.compile('(?=({}))'.format(literal_trie_pattern(distinct)))
+            self._covered = {literal: frozenset(idx for idx, other in enumerate(self.literals)
+                                                if other is not None and literal.startswith(other))
+                             for literal in distinct}
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def candidates(self, txt):
+        """Indices, in order, of the rules whose required literal occurs in txt, or which have none."""
+        if not txt.isascii():
+            # Case-insensitive matching of non-ASCII text isn't equivalent to str.lower()
+            return range(len(self.rules))
+        lowered = txt.lower()
+        if self._scanner is None:
+            # A few substring checks are quicker than starting the scanner
+            return [idx for idx, literal in enumerate(self.literals) if literal is None or literal in lowered]
+        found = set(self._unfiltered)
+        for literal in set(self._scanner.findall(lowered)):
+            found |= self._covered[literal]
+        return sorted(found)
+
+    def first_match(self, txt, concurrent=False, timed_out=None):
+        """Return the first rule (in configured order) that matches txt, or None.
+
+        A rule which runs out of time raises PatternTimeoutError, unless a `timed_out` list
+        is given, in which case the rule is appended to it and the remaining rules still run.
+        """
+        for idx in self.candidates(txt):
+            rule = self.rules[idx]
+            before_time = timeit.default_timer()
+            try:
+                matched = matchesIncludeExclude(rule.include, rule.exclude, txt, concurrent)
+            except TimeoutError:
+                rule.stats.record(timeit.default_timer() - before_time, False)
+                if timed_out is None:
+                    raise PatternTimeoutError(rule)
+                timed_out.append(rule)
+                continue
+            rule.stats.record(timeit.default_timer() - before_time, matched)
+            if matched:
+                return rule
+        return None
+
+
+class ChannelPolicy(NamedTuple):
+    """Immutable snapshot of everything automod enforces in a single channel."""
+    whitelist: 'RuleSet'
+    blacklist: 'RuleSet'
+    autoemoji: Tuple[str, ...]
+    image_only: bool
+    imagelimit_enabled: bool
+    image_limit: int
+    reset_message_count: int
+    image_reset_minutes: int
+    embedlimit_enabled: bool
+    embed_limit: int
+    immune_role_ids: frozenset
+    embed_immune_role_ids: frozenset
+
+    @property
+    def applies(self):
+        return bool(self.whitelist or self.blacklist or self.autoemoji
+                    or self.imagelimit_enabled or self.embedlimit_enabled)
+
+
+def build_channel_policy(channel_data, guild_data, patterns):
+    def rules(names):
+        result = []
+        for name in names:
+            if name not in patterns:
+                # Undefined or disabled
+                continue
+            result.append(AutoModRule(name, *patterns[name]))
+        return RuleSet(result)
+
+    return ChannelPolicy(
+        whitelist=rules(channel_data['whitelist']),
+        blacklist=rules(channel_data['blacklist']),
+        autoemoji=tuple(channel_data['autoemoji']),
+        image_only=channel_data['image_only'],
+        imagelimit_enabled=channel_data['imagelimit_enabled'],
+        image_limit=channel_data['image_limit'],
+        reset_message_count=channel_data['reset_message_count'],
+        image_reset_minutes=channel_data['image_reset_minutes'],
+        embedlimit_enabled=channel_data['embedlimit_enabled'],
+        embed_limit=channel_data['embed_limit'],
+        immune_role_ids=frozenset(guild_data['immune_role_ids']),
+        embed_immune_role_ids=frozenset(guild_data['embed_immune_role_ids']),
+    )
+
+
+class WatchdogPhrase(NamedTuple):
+    name: str
+    phrase: str
+    cooldown: int
+    regex: Any
+
+
+class WatchdogSnapshot(NamedTuple):
+    """Immutable copy of a guild's watchdog config with phrases precompiled."""
+    channel_id: Optional[int]
+    users: Dict[int, dict]
+    phrases: Tuple[WatchdogPhrase, ...]
+
+
+def build_watchdog(guild_data):
+    users = {int(uid): settings for uid, settings in guild_data['watched_users'].items()
+             if settings['cooldown'] > 0}
+    phrases = []
+    for name, settings in guild_data['phrases'].items():
+        if settings['cooldown'] <= 0 or settings.get('disabled'):
+            continue
+        try:
+            regex = re.compile(settings['phrase'], PATTERN_FLAGS)
+        except Exception:
+            logger.exception("Failed to compile watchdog phrase {}".format(name))
+            continue
+        phrases.append(WatchdogPhrase(name, settings['phrase'], settings['cooldown'], regex))
+    return WatchdogSnapshot(guild_data['watchdog_channel_id'], users, tuple(phrases))
+
+
+class CooldownMap:
+    """Cooldown expiry times keyed by id.
+
+    Expired entries behave exactly like missing ones, so they are swept out periodically
+    to keep the map from growing with every key ever seen.
+    """
+    __slots__ = ('_expiries', '_touches')
+
+    SWEEP_EVERY = 1000
+
+    def __init__(self):
+        self._expiries = {}
+        self._touches = 0
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def ready(self, key, now):
+        return self._expiries.get(key, 0) <= now
+
+    def touch(self, key, now, cooldown):
+        self._expiries[key] = now + cooldown
+        self._touches += 1
+        if self._touches >= self.SWEEP_EVERY:
+            self.sweep(now)
+
+    def clear(self, key):
+        self._expiries.pop(key, None)
+
+    def sweep(self, now):
+        self._touches = 0
+        self._expiries = {key: expiry for key, expiry in self._expiries.items() if expiry > now}
+
+
+class UserDataIndex:
+    """Maps user ids to the watchdog config entries that mention them.
+
+    Entries are (guild id, kind, key) where kind is 'watched' for a watched user (key is
+    their id), 'watchdog' for a watch the user requested (key is the watched user's id) and
+    'phrase' for a phrase the user created (key is the phrase name).
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._users = defaultdict(set)
+        self._guilds = {}
+
+    def lookup(self, user_id):
+        return sorted(self._users.get(user_id, ()))
+
+    def load_guild(self, guild_id, guild_data):
+        """Index a guild unless it has already been indexed from fresher data."""
+        if guild_id not in self._guilds:
+            self.update_guild(guild_id, guild_data)
+
+    def update_guild(self, guild_id, guild_data):
+        for user_id, entry in self._guilds.pop(guild_id, ()):
+            entries = self._users[user_id]
+            entries.discard(entry)
+            if not entries:
+                del self._users[user_id]
+
+        indexed = []
+        for uid, settings in guild_data['watched_users'].items():
+            indexed.append((int(uid), (guild_id, 'watched', uid)))
+            indexed.append((settings['request_user_id'], (guild_id, 'watchdog', uid)))
+        for name, settings in guild_data['phrases'].items():
+            indexed.append((settings['request_user_id'], (guild_id, 'phrase', name)))
+        for user_id, entry in indexed:
+            self._users[user_id].add(entry)
+        self._guilds[guild_id] = indexed
+
+
+def matchesIncludeExclude(include_pattern, exclude_pattern, txt, concurrent=False):
+    if matchesPattern(include_pattern, txt, concurrent):
+        return not matchesPattern(exclude_pattern, txt, concurrent)
+    return False
+
 
-    p = re.compile(pattern, re.IGNORECASE | re.MULTILINE | re.DOTALL)
-    return p.match(txt)
+def matchesPattern(pattern, txt, concurrent=False):
+    if not isinstance(pattern, CompiledPattern):
+        pattern = CompiledPattern(pattern)
+    return pattern.match(txt, concurrent)
 
 
 class AutoMod2Settings(CogSettings):
@@ -0,0 +1,107 @@
+import json
+import sqlite3
+import timeit
+
+from .automod import AutoModRule, CompiledPattern, PatternTimeoutError, RuleSet, RuleStats
+
+BATCH_SIZE = 500
+MAX_SAMPLES = 5
+
+
+class BacktestResult:
+    """Running totals for a pattern replayed against a message corpus."""
+
+    def __init__(self):
+        self.messages = 0
+        self.matches = 0
+        self.timeouts = 0
+        self.total_time = 0.
+        self.max_time = 0.
+        self.samples = []
+
+    def merge(self, other):
+        self.messages += other.messages
+        self.matches += other.matches
+        self.timeouts += other.timeouts
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+        self.samples.extend(other.samples[:MAX_SAMPLES - len(self.samples)])
+
+    def describe(self):
+        if not self.messages:
+            return "No messages to check."
+        return ("{} of {} messages matched ({:.2%}){}.\n"
+                "Average cost: {:.1f}us per message, worst: {:.3f}ms").format(
+            self.matches, self.messages, self.matches / self.messages,
+            ", {} timed out".format(self.timeouts) if self.timeouts else '',
+            self.total_time / self.messages * 1e6, self.max_time * 1000)
+
+
+def make_rule(include_pattern, exclude_pattern):
+    """A single-rule RuleSet, so that matching goes through the same prefilter as live messages."""
+    return RuleSet([AutoModRule('backtest', CompiledPattern(include_pattern),
+                                CompiledPattern(exclude_pattern), RuleStats())])
+
+
+def evaluate_batch(rule_set, contents):
+    """Run a batch of message contents through rule_set.  Meant to be run in an executor."""
+    result = BacktestResult()
+    for txt in contents:
+        before_time = timeit.default_timer()
+        try:
+            # Let the regex module release the GIL, so the event loop keeps running meanwhile
+            matched = rule_set.first_match(txt, concurrent=True) is not None
+        except PatternTimeoutError:
+            matched = False
+            result.timeouts += 1
+        elapsed = timeit.default_timer() - before_time
+
+        result.messages += 1
+        result.total_time += elapsed
+        result.max_time = max(result.max_time, elapsed)
+        if matched:
+            result.matches += 1
+            if len(result.samples) < MAX_SAMPLES:
+                result.samples.append(txt)
+    return result
+
+
+def iter_export(path, batch_size=BATCH_SIZE):
+    """Yield batches of message contents from an export.
+
+    .jsonl files hold one JSON object with a 'content' key per line.  .db/.sqlite files need
+    a `messages` table with a `content` column.
+    """
+    if path.endswith(('.db', '.sqlite', '.sqlite3')):
+        conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+        try:
+            cursor = conn.execute('SELECT content FROM messages')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield [row[0] for row in rows if row[0]]
+        finally:
+            conn.close()
+
+    batch = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            content = json.loads(line).get('content')
+            if content:
+                batch.append(content)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def backtest_export(rule_set, path):
+    """Stream an export through rule_set.  Meant to be run in an executor."""
+    result = BacktestResult()
+    for batch in iter_export(path):
+        result.merge(evaluate_batch(rule_set, batch))
+    return result
@@ -0,0 +1,389 @@
+import asyncio
+import copy
+import json
+import random
+import timeit
+from datetime import datetime, timezone
+
+import discord
+from redbot.core import Config
+
+from .automod import AutoMod, AutoModRule, CompiledPattern, MessageContext, RuleSet, RuleStats, matchesIncludeExclude
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do',
+         'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'room']
+
+
+def make_rules(count, seed=0):
+    """Build `count` synthetic blacklist rules resembling the ones used in practice."""
+    rng = random.Random(seed)
+    rules = []
+    for idx in range(count):
+        kind = idx % 4
+        if kind == 0:
+            include, exclude = r'.*\bbanned{}\b.*'.format(idx), ''
+        elif kind == 1:
+            include, exclude = r'^(sell|buy)ing{}\s.*'.format(idx), r'.*\bjk\b.*'
+        elif kind == 2:
+            include, exclude = r'.*https?://\S*spam{}\.\w+.*'.format(idx), ''
+        else:
+            include, exclude = r'.*{}\s+{}{}.*'.format(rng.choice(WORDS), rng.choice(WORDS), idx), r'.*test.*'
+        rules.append(AutoModRule('rule {}'.format(idx), CompiledPattern(include), CompiledPattern(exclude),
+                                 RuleStats()))
+    return rules
+
+
+def make_corpus(size, rule_count, hit_rate=.05, seed=0):
+    """Build `size` chat-like messages, roughly `hit_rate` of which trip a rule."""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 40))]
+        if rng.random() < hit_rate:
+            words.insert(rng.randrange(len(words)), 'banned{}'.format(4 * rng.randrange(max(rule_count // 4, 1))))
+        corpus.append(' '.join(words))
+    return corpus
+
+
+def per_message_us(fn, corpus, repeat=3):
+    """Best-of-`repeat` average cost of fn(txt) in microseconds per message."""
+    def run():
+        for txt in corpus:
+            fn(txt)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(corpus) * 1e6
+
+
+def matcher_benchmark(rule_counts=(10, 50, 200), corpus_size=1000):
+    """Compare a plain per-rule loop against RuleSet's prefiltered matching.
+
+    Returns a list of (rule count, loop us/msg, RuleSet us/msg) tuples.
+    """
+    results = []
+    for count in rule_counts:
+        rules = make_rules(count)
+        corpus = make_corpus(corpus_size, count)
+        rule_set = RuleSet(rules)
+
+        def loop(txt):
+            for rule in rules:
+                if matchesIncludeExclude(rule.include, rule.exclude, txt):
+                    return rule
+            return None
+
+        for txt in corpus:
+            if loop(txt) is not rule_set.first_match(txt):
+                raise ValueError("RuleSet disagrees with the per-rule loop on: {}".format(txt))
+
+        results.append((count, per_message_us(loop, corpus), per_message_us(rule_set.first_match, corpus)))
+    return results
+
+
+# Stand-ins for the discord objects the automod listeners touch.  They implement just enough for
+# the pipeline to run end to end without a gateway connection; every API call is a no-op.
+
+class ReplayPermissions:
+    def __init__(self, manage_messages=False):
+        self.manage_messages = manage_messages
+
+
+class ReplayRole:
+    def __init__(self, role_id):
+        self.id = role_id
+        self.mention = '<@&{}>'.format(role_id)
+
+
+class ReplayMember(discord.Member):
+    """A discord.Member that skips the gateway state, so that isinstance checks still pass."""
+
+    def __init__(self, guild, user_id, roles=(), moderator=False):
+        self._replay_guild = guild
+        self._replay_id = user_id
+        self._replay_roles = list(roles)
+        self.moderator = moderator
+        self.dms = 0
+
+    id = property(lambda self: self._replay_id)
+    guild = property(lambda self: self._replay_guild)
+    roles = property(lambda self: self._replay_roles)
+    bot = property(lambda self: False)
+    name = property(lambda self: 'user{}'.format(self._replay_id))
+    mention = property(lambda self: '<@{}>'.format(self._replay_id))
+
+    def __repr__(self):
+        return '<ReplayMember id={}>'.format(self.id)
+
+    async def send(self, content=None, **kwargs):
+        self.dms += 1
+
+
+class ReplayChannel:
+    def __init__(self, guild, channel_id):
+        self.guild = guild
+        self.id = channel_id
+        self.name = 'channel{}'.format(channel_id)
+        self.mention = '<#{}>'.format(channel_id)
+        self.sent = 0
+        self.deleted = 0
+
+    def permissions_for(self, member):
+        return ReplayPermissions(manage_messages=getattr(member, 'moderator', False))
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+    async def delete_messages(self, messages):
+        self.deleted += len(messages)
+
+    def get_partial_message(self, message_id):
+        return ReplayMessage(self, None, message_id, '')
+
+
+class ReplayGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.channels = {}
+        self.members = {}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_channel_or_thread(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def get_role(self, role_id):
+        return ReplayRole(role_id)
+
+
+class ReplayMessage:
+    def __init__(self, channel, author, message_id, content, attachments=0, embeds=0):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.id = message_id
+        self.content = content
+        self.clean_content = content
+        self.attachments = [None] * attachments
+        self.embeds = [None] * embeds
+        self.created_at = discord.utils.snowflake_time(message_id)
+
+    async def delete(self):
+        self.channel.deleted += 1
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class ReplayBot:
+    def __init__(self, guild, loop):
+        self.guild = guild
+        self.loop = loop
+        self.user = ReplayMember(guild, 1)
+
+    def get_channel(self, channel_id):
+        return self.guild.get_channel(channel_id)
+
+    async def wait_until_ready(self):
+        pass
+
+
+class MemoryValue:
+    """The subset of redbot's Value API the cog uses: await, async with, and set()."""
+
+    def __init__(self, data, key):
+        self._data = data
+        self._key = key
+
+    def __call__(self):
+        return self
+
+    def __await__(self):
+        yield from ()
+        return copy.deepcopy(self._data[self._key])
+
+    async def __aenter__(self):
+        return self._data[self._key]
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def set(self, value):
+        self._data[self._key] = value
+
+
+class MemoryGroup:
+    def __init__(self, data):
+        self._data = data
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return MemoryValue(self._data, key)
+
+    async def all(self):
+        return copy.deepcopy(self._data)
+
+
+class MemoryConfig:
+    """An in-memory replacement for the cog's Config, seeded with plain dicts."""
+
+    def __init__(self, guild_defaults, channel_defaults):
+        self.defaults = {Config.GUILD: guild_defaults, Config.CHANNEL: channel_defaults}
+        self.guilds = {}
+        self.channels = {}
+
+    def _scope(self, scope, defaults, obj_id):
+        if obj_id not in scope:
+            scope[obj_id] = copy.deepcopy(defaults)
+        return scope[obj_id]
+
+    def guild(self, guild):
+        return MemoryGroup(self._scope(self.guilds, self.defaults[Config.GUILD], guild.id))
+
+    def guild_from_id(self, guild_id):
+        return MemoryGroup(self._scope(self.guilds, self.defaults[Config.GUILD], guild_id))
+
+    def channel(self, channel):
+        return MemoryGroup(self._scope(self.channels, self.defaults[Config.CHANNEL], channel.id))
+
+    async def all_guilds(self):
+        return copy.deepcopy(self.guilds)
+
+    async def all_channels(self):
+        return copy.deepcopy(self.channels)
+
+
+# Registered defaults of the real cog, kept in sync with AutoMod.__init__
+GUILD_DEFAULTS = dict(patterns={}, phrases={}, watched_users={}, watchdog_channel_id=None,
+                      immune_role_ids=[], embed_immune_role_ids=[], max_pattern_cost_ms=10,
+                      pattern_stats={})
+CHANNEL_DEFAULTS = dict(whitelist=[], blacklist=[], autoemoji=[], image_only=False, image_limit=1,
+                        reset_message_count=10, image_reset_minutes=5, imagelimit_enabled=False,
+                        embedlimit_enabled=False, embed_limit=2)
+
+REPLAY_GUILD_ID = 1000
+REPLAY_CHANNEL_ID = 2000
+REPLAY_WATCHDOG_CHANNEL_ID = 2001
+REPLAY_MODERATOR_ID = 3000
+REPLAY_WATCHED_USER_ID = 3001
+
+
+def make_replay_corpus(size, rule_count, seed=0):
+    """Build `size` message records shaped like what load_replay_corpus reads."""
+    rng = random.Random(seed)
+    records = []
+    for content in make_corpus(size, rule_count, seed=seed):
+        roll = rng.random()
+        records.append({
+            'content': content,
+            'author_id': REPLAY_WATCHED_USER_ID + rng.randrange(50),
+            'attachments': 1 if roll < .1 else 0,
+            'embeds': 3 if roll > .98 else 0,
+        })
+    return records
+
+
+def load_replay_corpus(path):
+    """Read a recorded corpus: one JSON object per line with 'content' and optionally
+    'author_id', 'attachments' and 'embeds' (counts)."""
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def make_replay_cog(loop, rule_count):
+    """Build an AutoMod cog wired to stand-in objects, configured with `rule_count` blacklist
+    rules, image and embed limits, a watched user and a few watchdog phrases."""
+    guild = ReplayGuild(REPLAY_GUILD_ID)
+    for channel_id in (REPLAY_CHANNEL_ID, REPLAY_WATCHDOG_CHANNEL_ID):
+        guild.channels[channel_id] = ReplayChannel(guild, channel_id)
+    bot = ReplayBot(guild, loop)
+
+    config = MemoryConfig(GUILD_DEFAULTS, CHANNEL_DEFAULTS)
+    rules = make_rules(rule_count)
+    config.guilds[guild.id] = dict(copy.deepcopy(GUILD_DEFAULTS), **{
+        'patterns': {rule.name: {'include_pattern': rule.include.source, 'exclude_pattern': rule.exclude.source}
+                     for rule in rules},
+        'phrases': {'phrase {}'.format(idx): {'request_user_id': REPLAY_MODERATOR_ID, 'cooldown': 300,
+                                             'phrase': r'.*\b{}{}\b.*'.format(word, idx)}
+                    for idx, word in enumerate(WORDS[:5])},
+        'watched_users': {str(REPLAY_WATCHED_USER_ID): {'request_user_id': REPLAY_MODERATOR_ID, 'cooldown': 60,
+                                                   'reason': 'benchmark'}},
+        'watchdog_channel_id': REPLAY_WATCHDOG_CHANNEL_ID,
+    })
+    config.channels[REPLAY_CHANNEL_ID] = dict(copy.deepcopy(CHANNEL_DEFAULTS), **{
+        'blacklist': [rule.name for rule in rules],
+        'imagelimit_enabled': True,
+        'image_limit': 2,
+        'embedlimit_enabled': True,
+    })
+
+    return AutoMod(bot, config=config)
+
+
+async def replay(cog, records):
+    """Feed records through the cog's message pipeline, timing each stage of every message.
+
+    Returns ({stage name: [seconds]}, total seconds).
+    """
+    guild = cog.bot.guild
+    channel = guild.get_channel(REPLAY_CHANNEL_ID)
+    members = {}
+    timings = {name: [] for name, _ in cog.message_stages}
+    base_id = discord.utils.time_snowflake(datetime.now(timezone.utc))
+
+    start_time = timeit.default_timer()
+    for idx, record in enumerate(records):
+        author_id = record.get('author_id', REPLAY_WATCHED_USER_ID)
+        author = members.get(author_id)
+        if author is None:
+            author = members[author_id] = guild.members[author_id] = ReplayMember(guild, author_id)
+        message = ReplayMessage(channel, author, base_id + (idx << 22), record['content'],
+                                record.get('attachments', 0), record.get('embeds', 0))
+        msg_ctx = MessageContext(message, cog.channel_policies.get(channel.id))
+        await cog.run_pipeline(msg_ctx, cog.message_stages, timings)
+    return timings, timeit.default_timer() - start_time
+
+
+def percentile(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def replay_benchmark(rule_counts=(10, 50, 200), corpus_size=2000, records=None):
+    """Replay a corpus through the full message pipeline at several rule counts.
+
+    Runs its own event loop, so call it from an executor.  Returns a list of
+    (rule count, stage, messages/s, p50 us, p99 us) tuples; the stage 'total' covers the
+    whole pipeline.
+    """
+    async def run(count):
+        cog = make_replay_cog(asyncio.get_running_loop(), count)
+        try:
+            await cog.init()
+            corpus = records if records is not None else make_replay_corpus(corpus_size, count)
+            # One untimed pass to warm up regex and policy caches
+            await replay(cog, corpus[:100])
+            return await replay(cog, corpus)
+        finally:
+            await cog.cog_unload()
+
+    results = []
+    for count in rule_counts:
+        timings, total = asyncio.run(run(count))
+        for name, samples in timings.items():
+            if not samples:
+                continue
+            samples.sort()
+            results.append((count, name, len(samples) / sum(samples),
+                            percentile(samples, .5) * 1e6, percentile(samples, .99) * 1e6))
+        message_count = max(len(samples) for samples in timings.values())
+        results.append((count, 'total', message_count / total, None, None))
+    return results
@@ -0,0 +1,279 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+import discord
+from redbot.core.utils.chat_formatting import pagify
+
+logger = logging.getLogger('red.misc-cogs.automod')
+
+# Discord refuses to bulk delete messages older than two weeks; leave a little slack
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+BULK_DELETE_MAX_COUNT = 100
+
+
+class DeletionQueue:
+    """Coalesces message deletions per channel so they can be removed with bulk deletes.
+
+    Requests for the same channel that arrive within `window` seconds of the first one
+    are deleted together.
+    """
+
+    def __init__(self, window=.5):
+        self.window = window
+        self._pending = {}
+
+    def enqueue(self, channel, message_ids):
+        """Queue messages for deletion without waiting.  Returns a future for the set of
+        ids which were deleted; failures are logged, so it may be ignored."""
+        pending = self._pending.get(channel.id)
+        if pending is None:
+            future = asyncio.get_running_loop().create_future()
+            # Mark the outcome as retrieved, for callers that don't wait on it
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            task = asyncio.ensure_future(self._flush_later(channel.id))
+            pending = self._pending[channel.id] = (channel, set(), future, task)
+        pending[1].update(message_ids)
+        return pending[2]
+
+    async def delete(self, channel, message_ids):
+        """Queue messages for deletion, returning the set of ids which were deleted."""
+        return await asyncio.shield(self.enqueue(channel, message_ids))
+
+    def close(self):
+        """Drop deletions which haven't been sent yet, cancelling anything waiting on them."""
+        for _, _, future, task in self._pending.values():
+            task.cancel()
+            future.cancel()
+        self._pending.clear()
+
+    async def _flush_later(self, channel_id):
+        await asyncio.sleep(self.window)
+        channel, message_ids, future, _ = self._pending.pop(channel_id)
+        try:
+            deleted = await self._delete_all(channel, message_ids)
+        except Exception as ex:
+            logger.exception("Failed to delete messages in {}".format(channel_id))
+            future.set_exception(ex)
+        else:
+            future.set_result(deleted)
+
+    async def _delete_all(self, channel, message_ids):
+        cutoff = discord.utils.time_snowflake(datetime.now(timezone.utc) - BULK_DELETE_MAX_AGE)
+        recent = sorted(mid for mid in message_ids if mid > cutoff)
+        old = [mid for mid in message_ids if mid <= cutoff]
+
+        deleted = set()
+        for idx in range(0, len(recent), BULK_DELETE_MAX_COUNT):
+            chunk = recent[idx:idx + BULK_DELETE_MAX_COUNT]
+            try:
+                await channel.delete_messages([discord.Object(id=mid) for mid in chunk])
+                deleted.update(chunk)
+            except discord.HTTPException:
+                old.extend(chunk)
+
+        for mid in old:
+            try:
+                await channel.get_partial_message(mid).delete()
+                deleted.add(mid)
+            except discord.NotFound:
+                pass
+            except discord.HTTPException:
+                logger.exception("Failed to delete message {}".format(mid))
+        return deleted
+
+
+def split_content(content, limit):
+    """Split text longer than limit into pieces that fit, re-boxing each piece of a code block."""
+    if len(content) <= limit:
+        yield content
+        return
+    if content.startswith('```') and content.endswith('\n```') and '\n' in content[:-4]:
+        header = content[:content.index('\n') + 1]
+        for page in pagify(content[len(header):-4], page_length=limit - len(header) - 4):
+            yield header + page + '\n```'
+        return
+    yield from pagify(content, page_length=limit)
+
+
+class OutboxItem:
+    __slots__ = ('destination', 'contents')
+
+    def __init__(self, destination, content):
+        self.destination = destination
+        self.contents = [content]
+
+
+class ReportOutbox:
+    """Sends moderation DMs and watchdog posts from background workers.
+
+    Sends to the same destination are spaced at least `min_interval` seconds apart.
+    A DM queued with `coalesce=True` goes out straight away and opens a `coalesce_window`
+    second window; any further ones to the same user in that window are merged into a
+    single message sent when it closes.  When the queue is full, new items are dropped
+    and counted.
+    """
+
+    def __init__(self, maxsize=500, workers=4, min_interval=1., coalesce_window=3.):
+        self.min_interval = min_interval
+        self.coalesce_window = coalesce_window
+        self.queue = asyncio.Queue(maxsize)
+        self.workers = workers
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+        self._coalescing = {}
+        self._next_send = {}
+        self._tasks = []
+
+    def start(self, loop):
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for _, handle in self._coalescing.values():
+            handle.cancel()
+        self._coalescing.clear()
+
+    @property
+    def depth(self):
+        return self.queue.qsize() + sum(item is not None for item, _ in self._coalescing.values())
+
+    def send(self, destination, content, coalesce=False):
+        if not coalesce:
+            self._enqueue(OutboxItem(destination, content))
+            return
+
+        pending = self._coalescing.get(destination.id)
+        if pending is None:
+            # Nothing recent for this user, so don't hold this one back
+            self._enqueue(OutboxItem(destination, content))
+            handle = asyncio.get_running_loop().call_later(self.coalesce_window, self._release, destination.id)
+            self._coalescing[destination.id] = (None, handle)
+        elif pending[0] is None:
+            self._coalescing[destination.id] = (OutboxItem(destination, content), pending[1])
+        else:
+            pending[0].contents.append(content)
+            self.coalesced += 1
+
+    def _release(self, key):
+        item, _ = self._coalescing.pop(key)
+        if item is not None:
+            self._enqueue(item)
+
+    def _enqueue(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            try:
+                # Reserve the next free slot for this destination before sleeping, so that
+                # other workers queue up behind it rather than sending at the same time
+                now = loop.time()
+                key = item.destination.id
+                slot = max(now, self._next_send.get(key, 0))
+                self._next_send[key] = slot + self.min_interval
+                if slot > now:
+                    await asyncio.sleep(slot - now)
+                for page in self._pages(item.contents):
+                    await item.destination.send(page)
+                self.sent += 1
+            except asyncio.CancelledError:
+                raise
+            except discord.Forbidden:
+                self.failed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Failed to send to {}".format(item.destination))
+            finally:
+                self.queue.task_done()
+                if len(self._next_send) > self.queue.maxsize:
+                    now = loop.time()
+                    self._next_send = {k: t for k, t in self._next_send.items() if t > now}
+
+    @staticmethod
+    def _pages(contents, limit=2000):
+        page = ''
+        for content in (part for content in contents for part in split_content(content, limit)):
+            if page and len(page) + len(content) + 1 > limit:
+                yield page
+                page = ''
+            page = page + '\n' + content if page else content
+        if page:
+            yield page
+
+
+class ReactionScheduler:
+    """Adds reactions in the background without waiting on each round trip.
+
+    Per channel, reactions are started in the order they were scheduled and no more than
+    once every `interval` seconds, which is Discord's rate limit for adding reactions.
+    At most `maxlen` reactions wait per channel; beyond that new ones are dropped and
+    counted, rather than piling up and arriving minutes late.
+    """
+
+    def __init__(self, interval=.25, maxlen=40):
+        self.interval = interval
+        self.maxlen = maxlen
+        self.dropped = 0
+        self._pending = {}
+        self._tasks = {}
+        self._in_flight = set()
+
+    @property
+    def depth(self):
+        return sum(len(pending) for pending in self._pending.values())
+
+    def add(self, message, emojis):
+        pending = self._pending.get(message.channel.id)
+        if pending is None:
+            pending = self._pending[message.channel.id] = deque()
+            self._tasks[message.channel.id] = asyncio.ensure_future(self._drain(message.channel.id))
+        for emoji in emojis:
+            if len(pending) >= self.maxlen:
+                self.dropped += 1
+            else:
+                pending.append((message, emoji))
+
+    async def close(self):
+        """Stop adding reactions, and wait for the channel drains and requests to finish cancelling."""
+        tasks = list(self._tasks.values()) + list(self._in_flight)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Drains cancelled before they started never reach their own cleanup
+        self._pending.clear()
+        self._tasks.clear()
+
+    async def _drain(self, channel_id):
+        pending = self._pending[channel_id]
+        try:
+            while pending:
+                message, emoji = pending.popleft()
+                # Keep a reference so the request isn't garbage collected before it finishes
+                task = asyncio.ensure_future(self._react(message, emoji))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+                await asyncio.sleep(self.interval)
+        finally:
+            del self._pending[channel_id]
+            del self._tasks[channel_id]
+
+    async def _react(self, message, emoji):
+        try:
+            await message.add_reaction(emoji)
+        except discord.NotFound:
+            # The message was deleted in the meantime
+            pass
+        except discord.HTTPException:
+            logger.exception("Failed to add reaction {} to {}".format(emoji, message.id))
@@ -0,0 +1,258 @@
+import timeit
+from typing import List, NamedTuple, Optional
+
+try:
+    import regex as re
+except ImportError:
+    import re
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+# Small alphabet used to approximate which characters a piece of a pattern can start with
+PROBE_CHARS = 'a0 _!.\n'
+
+# Discord's message length limit; the longest text a pattern will ever be run against
+MAX_MESSAGE_LENGTH = 2000
+
+# Longest a single fuzz match may run for.  Anything hitting this is reported as at least this slow.
+FUZZ_TIMEOUT = .25
+
+REPEAT_OPS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+ATOMIC_OPS = {getattr(sre_constants, name) for name in ('POSSESSIVE_REPEAT', 'ATOMIC_GROUP')
+              if hasattr(sre_constants, name)}
+MAXREPEAT = sre_constants.MAXREPEAT
+
+CATEGORY_CHECKS = {
+    sre_constants.CATEGORY_DIGIT: str.isdigit,
+    sre_constants.CATEGORY_NOT_DIGIT: lambda c: not c.isdigit(),
+    sre_constants.CATEGORY_SPACE: str.isspace,
+    sre_constants.CATEGORY_NOT_SPACE: lambda c: not c.isspace(),
+    sre_constants.CATEGORY_WORD: lambda c: c.isalnum() or c == '_',
+    sre_constants.CATEGORY_NOT_WORD: lambda c: not (c.isalnum() or c == '_'),
+}
+
+
+class PatternCost(NamedTuple):
+    issues: List[str]
+    worst_case_ms: Optional[float]
+    worst_input: Optional[str]
+
+    def describe(self):
+        lines = []
+        if self.worst_case_ms is not None:
+            if self.worst_case_ms >= FUZZ_TIMEOUT * 1000:
+                lines.append("Estimated worst case: over {}ms per message".format(int(FUZZ_TIMEOUT * 1000)))
+            else:
+                lines.append("Estimated worst case: {:.2f}ms per message".format(self.worst_case_ms))
+        lines.extend("- " + issue for issue in self.issues)
+        return '\n'.join(lines)
+
+
+def analyse_pattern(pattern, flags=0):
+    """Statically look for catastrophic backtracking and then time the pattern on adversarial input.
+
+    Meant to be run in an executor; the fuzzing may take up to a couple of seconds for bad patterns.
+    """
+    issues = []
+    pumps = []
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        # Syntax only the regex module understands; fall back to generic fuzzing
+        parsed = None
+    else:
+        _walk(parsed, issues, pumps, '')
+
+    worst_case_ms, worst_input = fuzz(pattern, flags, pumps)
+    # The same construct can be reported from several places in the pattern
+    return PatternCost(list(dict.fromkeys(issues)), worst_case_ms, worst_input)
+
+
+def _walk(seq, issues, pumps, prefix):
+    previous = None
+    for op, av in seq:
+        if op in ATOMIC_OPS:
+            # Possessive/atomic constructs never backtrack into their body
+            previous = None
+        elif op in REPEAT_OPS:
+            low, high, body = av
+            if (high == MAXREPEAT or high >= 10) and _has_variable_repeat(body):
+                issues.append("Nested quantifiers, e.g. (a+)+: the same text can be split between the inner and"
+                              " outer repeat in exponentially many ways")
+                pumps.append((prefix, sample(body)))
+            if high == MAXREPEAT:
+                branches = _branches(body)
+                if branches and _overlapping([first_chars(b) for b in branches]):
+                    issues.append("Overlapping alternation under a quantifier, e.g. (a|ab)+: several"
+                                  " branches can match the same text")
+                    pumps.append((prefix, sample(body)))
+                if previous is not None and previous & first_chars(body):
+                    issues.append("Adjacent quantifiers over the same characters, e.g. \\d+\\d+: the split"
+                                  " point between them is tried at every position")
+                    pumps.append((prefix, sample(body)))
+                previous = _repeated_chars(body)
+            else:
+                previous = None
+            _walk(body, issues, pumps, prefix)
+        elif op is sre_constants.SUBPATTERN:
+            _walk(av[-1], issues, pumps, prefix)
+            previous = None
+        elif op is sre_constants.BRANCH:
+            for branch in av[1]:
+                _walk(branch, issues, pumps, prefix)
+            previous = None
+        elif op is not sre_constants.AT:
+            previous = None
+        prefix += sample([(op, av)])
+
+
+def _branches(seq):
+    """The alternatives of a repeated body which is (possibly a group around) a single branch."""
+    while len(seq) == 1:
+        op, av = seq[0]
+        if op is sre_constants.BRANCH:
+            return av[1]
+        if op is not sre_constants.SUBPATTERN:
+            return None
+        seq = av[-1]
+    return None
+
+
+def _has_variable_repeat(seq):
+    for op, av in seq:
+        if op in REPEAT_OPS:
+            low, high, body = av
+            if high > 1 and high != low:
+                return True
+            if _has_variable_repeat(body):
+                return True
+        elif op is sre_constants.SUBPATTERN:
+            if _has_variable_repeat(av[-1]):
+                return True
+        elif op is sre_constants.BRANCH:
+            if any(_has_variable_repeat(branch) for branch in av[1]):
+                return True
+    return False
+
+
+def _overlapping(char_sets):
+    seen = set()
+    for chars in char_sets:
+        if seen & chars:
+            return True
+        seen |= chars
+    return False
+
+
+def _repeated_chars(seq):
+    """Probe characters that a repeated body can consume."""
+    chars = set()
+    for op, av in seq:
+        if op in REPEAT_OPS:
+            chars |= _repeated_chars(av[2])
+        elif op is sre_constants.SUBPATTERN:
+            chars |= _repeated_chars(av[-1])
+        elif op is sre_constants.BRANCH:
+            for branch in av[1]:
+                chars |= _repeated_chars(branch)
+        else:
+            chars |= {c for c in PROBE_CHARS if matches_char(op, av, c)}
+    return chars
+
+
+def first_chars(seq):
+    """Probe characters that a sequence of parsed items can start with."""
+    chars = set()
+    for op, av in seq:
+        if op is sre_constants.AT:
+            continue
+        if op in REPEAT_OPS:
+            chars |= first_chars(av[2])
+            if av[0] > 0:
+                return chars
+        elif op is sre_constants.SUBPATTERN:
+            return chars | first_chars(av[-1])
+        elif op is sre_constants.BRANCH:
+            for branch in av[1]:
+                chars |= first_chars(branch)
+            return chars
+        else:
+            return chars | {c for c in PROBE_CHARS if matches_char(op, av, c)}
+    return chars
+
+
+def matches_char(op, av, c):
+    if op is sre_constants.LITERAL:
+        return chr(av).lower() == c.lower()
+    if op is sre_constants.NOT_LITERAL:
+        return chr(av).lower() != c.lower()
+    if op is sre_constants.ANY:
+        return True
+    if op is sre_constants.IN:
+        negate = False
+        found = False
+        for item_op, item_av in av:
+            if item_op is sre_constants.NEGATE:
+                negate = True
+            elif item_op is sre_constants.LITERAL:
+                found |= chr(item_av).lower() == c.lower()
+            elif item_op is sre_constants.RANGE:
+                found |= item_av[0] <= ord(c) <= item_av[1] or item_av[0] <= ord(c.lower()) <= item_av[1]
+            elif item_op is sre_constants.CATEGORY:
+                found |= CATEGORY_CHECKS.get(item_av, lambda _: True)(c)
+        return found != negate
+    return False
+
+
+def sample(seq):
+    """A short string matching a sequence of parsed items, as best as can be cheaply guessed."""
+    result = ''
+    for op, av in seq:
+        if op in REPEAT_OPS:
+            result += sample(av[2]) * max(av[0], 1)
+        elif op in ATOMIC_OPS:
+            # Possessive repeats carry (min, max, body), atomic groups just the body
+            result += sample(av[2] if isinstance(av, tuple) else av)
+        elif op is sre_constants.SUBPATTERN:
+            result += sample(av[-1])
+        elif op is sre_constants.BRANCH:
+            result += sample(av[1][0])
+        elif op is sre_constants.LITERAL:
+            result += chr(av)
+        else:
+            result += next((c for c in PROBE_CHARS if matches_char(op, av, c)), '')
+    return result
+
+
+def fuzz(pattern, flags, pumps):
+    """Time the pattern against long strings built from repeated pieces followed by a mismatch.
+
+    Returns (worst time in ms, input that caused it).
+    """
+    if re.__name__ != 'regex':
+        # Without match timeouts a catastrophic pattern could hang the worker forever
+        return None, None
+
+    compiled = re.compile(pattern, flags)
+    candidates = list(dict.fromkeys(pumps + [('', c) for c in PROBE_CHARS] + [('', 'a '), ('', 'a0')]))
+
+    worst_ms, worst_input = 0, None
+    for prefix, pump in candidates:
+        if not pump:
+            continue
+        for suffix in ('!', '\n', ''):
+            count = max((MAX_MESSAGE_LENGTH - len(prefix) - len(suffix)) // len(pump), 1)
+            txt = prefix + pump * count + suffix
+            before_time = timeit.default_timer()
+            try:
+                compiled.match(txt, timeout=FUZZ_TIMEOUT, concurrent=True)
+            except TimeoutError:
+                return FUZZ_TIMEOUT * 1000, txt
+            elapsed_ms = (timeit.default_timer() - before_time) * 1000
+            if elapsed_ms > worst_ms:
+                worst_ms, worst_input = elapsed_ms, txt
+    return worst_ms, worst_input
@@ -0,0 +1,211 @@
+import asyncio
+import re
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip('redbot')
+
+import discord
+
+from .automod import AutoModRule, CompiledPattern, RuleSet, RuleStats, required_literal
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    from redbot.core import data_manager
+    monkeypatch.setattr(data_manager, 'basic_config', dict(data_manager.basic_config_default, DATA_PATH=str(tmp_path)))
+
+
+def make_rule_set(*includes):
+    return RuleSet(AutoModRule(name=str(idx), include=CompiledPattern(include),
+                               exclude=CompiledPattern(''), stats=RuleStats())
+                   for idx, include in enumerate(includes))
+
+
+@pytest.mark.parametrize('pattern, literal', [
+    (r'.*\bbadword\b.*', 'badword'),
+    ('.*(foo|bar) BAZ.*', ' baz'),
+    ('.*ab.*', None),
+])
+def test_required_literal(pattern, literal):
+    assert required_literal(pattern) == literal
+
+
+@pytest.mark.parametrize('pattern', [
+    '[[:alpha:]]oo.*',
+    '[[:^digit:]]+ foo.*',
+    '[[a-z]--[aeiou]]oo.*',
+    '[[ab]c]oo.*',
+    '(?V1)[[a-z]&&[^q]]oo.*',
+])
+def test_required_literal_skips_posix_classes_and_nested_sets(pattern):
+    assert required_literal(pattern) is None
+
+
+def test_candidates_match_substring_checks():
+    words = ['ban', 'banned', 'banned1', 'banned12', 'anne', 'spam.', 'a.b', 'x y'] + \
+            ['word{}'.format(idx) for idx in range(20)]
+    rules = make_rule_set('.*[0-9]', *('.*{}.*'.format(re.escape(word)) for word in words))
+    assert rules._scanner is not None
+    for txt in ['BANNED12 now', 'word1 word19', 'spam.x a.b', 'x  y', 'nothing', 'annex', 'café banned']:
+        lowered = txt.lower()
+        expected = [0] + [idx + 1 for idx, word in enumerate(words) if word in lowered]
+        assert list(rules.candidates(txt)) == (list(range(len(rules))) if not txt.isascii() else expected)
+
+
+def test_first_match_with_posix_class():
+    rules = make_rule_set('[[:alpha:]]oo.*')
+    assert rules.first_match('foo bar') is not None
+
+
+def test_timed_out_rule_does_not_stop_other_rules(monkeypatch, data_path):
+    from . import automod
+    from .benchmark import REPLAY_CHANNEL_ID, ReplayMember, ReplayMessage, make_replay_cog
+
+    def timed_match(regex, txt, concurrent=False):
+        if regex.pattern == '.*slow.*':
+            raise TimeoutError
+        return regex.match(txt)
+
+    monkeypatch.setattr(automod, 'timed_match', timed_match)
+
+    async def run():
+        cog = make_replay_cog(asyncio.get_running_loop(), 0)
+        try:
+            guild_data = cog.config.guilds[cog.bot.guild.id]
+            guild_data['patterns'] = {name: {'include_pattern': '.*{}.*'.format(name), 'exclude_pattern': ''}
+                                      for name in ('slow', 'spam')}
+            cog.config.channels[REPLAY_CHANNEL_ID]['blacklist'] = ['slow', 'spam']
+            await cog.init()
+
+            channel = cog.bot.get_channel(REPLAY_CHANNEL_ID)
+            author = ReplayMember(cog.bot.guild, 5000)
+            message = ReplayMessage(channel, author, discord.utils.time_snowflake(datetime.now(timezone.utc)),
+                                    'slow spam')
+            msg_ctx = automod.MessageContext(message, cog.channel_policies[REPLAY_CHANNEL_ID])
+            await cog.mod_message(msg_ctx)
+            return msg_ctx, channel, guild_data
+        finally:
+            await cog.cog_unload()
+
+    msg_ctx, channel, guild_data = asyncio.run(run())
+    assert msg_ctx.deleted
+    assert channel.deleted == 1
+    assert guild_data['patterns']['slow'].get('disabled')
+    assert not guild_data['patterns']['spam'].get('disabled')
+
+
+def test_reaction_scheduler_bounds_and_close():
+    from .queues import ReactionScheduler
+
+    class Channel:
+        id = 1
+
+    class Message:
+        channel = Channel()
+        reactions = 0
+
+        async def add_reaction(self, emoji):
+            self.reactions += 1
+
+    async def run():
+        scheduler = ReactionScheduler(interval=60, maxlen=3)
+        message = Message()
+        scheduler.add(message, ['a', 'b', 'c', 'd', 'e'])
+        dropped, depth = scheduler.dropped, scheduler.depth
+        await scheduler.close()
+        return dropped, depth, scheduler
+
+    dropped, depth, scheduler = asyncio.run(run())
+    assert (dropped, depth) == (2, 3)
+    assert not scheduler._tasks and not scheduler._in_flight
+
+
+def test_deletion_queue_close_cancels_waiting_callers():
+    from .queues import DeletionQueue
+
+    class Channel:
+        id = 1
+
+    async def run():
+        queue = DeletionQueue(window=60)
+        waiter = asyncio.ensure_future(queue.delete(Channel(), [1, 2]))
+        await asyncio.sleep(0)
+        queue.close()
+        return await asyncio.gather(waiter, return_exceptions=True)
+
+    result, = asyncio.run(run())
+    assert isinstance(result, asyncio.CancelledError)
+
+
+def test_whitelist_skipped_once_blacklisted(data_path):
+    from . import automod
+    from .benchmark import REPLAY_CHANNEL_ID, ReplayMember, ReplayMessage, make_replay_cog
+
+    async def run():
+        cog = make_replay_cog(asyncio.get_running_loop(), 0)
+        try:
+            guild_data = cog.config.guilds[cog.bot.guild.id]
+            guild_data['patterns'] = {name: {'include_pattern': '.*{}.*'.format(name), 'exclude_pattern': ''}
+                                      for name in ('spam', 'allowed')}
+            cog.config.channels[REPLAY_CHANNEL_ID].update(blacklist=['spam'], whitelist=['allowed'])
+            await cog.init()
+
+            channel = cog.bot.get_channel(REPLAY_CHANNEL_ID)
+            message = ReplayMessage(channel, ReplayMember(cog.bot.guild, 5000),
+                                    discord.utils.time_snowflake(datetime.now(timezone.utc)), 'allowed spam')
+            policy = cog.channel_policies[REPLAY_CHANNEL_ID]
+            msg_ctx = automod.MessageContext(message, policy)
+            await cog.mod_message(msg_ctx)
+            return msg_ctx, policy
+        finally:
+            await cog.cog_unload()
+
+    msg_ctx, policy = asyncio.run(run())
+    assert msg_ctx.deleted
+    assert next(iter(policy.whitelist)).stats.evaluations == 0
+
+
+def test_outbox_sends_first_dm_immediately_and_merges_follow_ups():
+    from .queues import ReportOutbox
+
+    class User:
+        id = 1
+
+        def __init__(self):
+            self.sent = []
+
+        async def send(self, content):
+            self.sent.append(content)
+
+    async def run():
+        outbox = ReportOutbox(min_interval=0, coalesce_window=.05)
+        outbox.start(asyncio.get_running_loop())
+        user = User()
+        try:
+            outbox.send(user, 'first', coalesce=True)
+            await asyncio.sleep(.01)
+            first = list(user.sent)
+            outbox.send(user, 'second', coalesce=True)
+            outbox.send(user, 'third', coalesce=True)
+            await asyncio.sleep(.1)
+            return first, user.sent
+        finally:
+            outbox.close()
+
+    first, sent = asyncio.run(run())
+    assert first == ['first']
+    assert sent == ['first', 'second\nthird']
+
+
+def test_outbox_pages_fit_message_limit():
+    from redbot.core.utils.chat_formatting import box
+
+    from .queues import ReportOutbox
+
+    long_item = box('\n'.join('line {}'.format(idx) for idx in range(1000)))
+    pages = list(ReportOutbox._pages(['short', long_item, 'x' * 2500]))
+    assert all(len(page) <= 2000 for page in pages)
+    assert pages[0].startswith('short')
+    assert all(page.count('```') % 2 == 0 for page in pages)
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+from .db import SeniorityDB
+
+
+def make_point_rows(count, seed=0):
+    """Build `count` (day, server, channel, user, points) rows resembling a day of chat."""
+    rng = random.Random(seed)
+    return [(18628, 1000, 2000 + rng.randrange(5), 3000 + rng.randrange(500), rng.random() * 5)
+            for _ in range(count)]
+
+
+def percentile(samples, fraction):
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+async def time_statements(execute, query, rows):
+    """Per-row latencies of awaiting execute(query, *row) for each row."""
+    samples = []
+    for row in rows:
+        before_time = timeit.default_timer()
+        await execute(query, *row)
+        samples.append(timeit.default_timer() - before_time)
+    return samples
+
+
+async def bench_aioodbc(path, create_statements, query, rows):
+    """The previous backend: an aioodbc pool over the SQLite3 ODBC driver, one autocommit
+    REPLACE per message.  Returns None if aioodbc or the driver is not installed."""
+    try:
+        import aioodbc
+    except ImportError:
+        return None
+    if os.name != 'nt' and sys.platform != 'win32':
+        dsn = 'Driver=SQLite3;Database=' + path
+    else:
+        dsn = 'Driver=SQLite3 ODBC Driver;Database=' + path
+    try:
+        pool = await aioodbc.create_pool(dsn=dsn, autocommit=True)
+    except Exception:
+        return None
+    try:
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for statement in create_statements:
+                    await cur.execute(statement)
+                return await time_statements(cur.execute, query, rows)
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+
+async def bench_aiosqlite(path, create_statements, query, rows, pragmas=None, batched=False):
+    db = SeniorityDB(path, pragmas=pragmas)
+    await db.open()
+    try:
+        for statement in create_statements:
+            await db.execute(statement)
+        if not batched:
+            return await time_statements(db.execute, query, rows)
+        before_time = timeit.default_timer()
+        await db.executemany(query, rows)
+        return [(timeit.default_timer() - before_time) / len(rows)] * len(rows)
+    finally:
+        await db.close()
+
+
+def insert_benchmark(create_statements, query, count=2000):
+    """Time writing `count` point rows with the old and new storage backends.
+
+    Runs its own event loop, so call it from an executor.  Returns a list of
+    (backend, p50 us, p99 us, mean us) tuples per message; backends which cannot run here
+    are reported with None timings.
+    """
+    rows = make_point_rows(count)
+    cases = [
+        ('aioodbc (before)', lambda path: bench_aioodbc(path, create_statements, query, rows)),
+        ('aiosqlite, default pragmas', lambda path: bench_aiosqlite(path, create_statements, query, rows, [])),
+        ('aiosqlite, WAL', lambda path: bench_aiosqlite(path, create_statements, query, rows)),
+        ('aiosqlite, WAL, batched flush',
+         lambda path: bench_aiosqlite(path, create_statements, query, rows, batched=True)),
+    ]
+
+    results = []
+    for name, case in cases:
+        with tempfile.TemporaryDirectory() as folder:
+            samples = asyncio.run(case(os.path.join(folder, 'bench.db')))
+        if not samples:
+            results.append((name, None, None, None))
+            continue
+        samples.sort()
+        results.append((name, percentile(samples, .5) * 1e6, percentile(samples, .99) * 1e6,
+                        sum(samples) / len(samples) * 1e6))
+    return results
+
+
+# Stand-ins for the guild, role and member objects role evaluation reads
+class BenchRole:
+    def __init__(self, role_id):
+        self.id = role_id
+        self.position = role_id
+        self.members = []
+
+
+class BenchMember:
+    def __init__(self, guild_roles, user_id):
+        self._guild_roles = guild_roles
+        self._role_ids = []
+        self.id = user_id
+
+    @property
+    def roles(self):
+        # Like discord.Member.roles, a fresh list of the member's roles sorted by position
+        result = [self._guild_roles[role_id] for role_id in self._role_ids]
+        result.sort(key=lambda role: role.position)
+        return result
+
+
+class BenchGuild:
+    def __init__(self, members):
+        self.members = members
+        self._members = {member.id: member for member in members}
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+
+def make_guild(member_count, seed=0):
+    """A guild where 10% of members hold the role, and 30% have points between 0 and 100."""
+    rng = random.Random(seed)
+    guild_roles = {role_id: BenchRole(role_id) for role_id in range(1, 6)}
+    role = guild_roles[1]
+    members = [BenchMember(guild_roles, 10 ** 17 + idx) for idx in range(member_count)]
+    for member in members:
+        # Every member carries a few other roles, as they would in practice
+        member._role_ids = [2, 3, 4]
+        if rng.random() < .1:
+            member._role_ids.append(role.id)
+            role.members.append(member)
+    points = [(member.id, rng.random() * 100) for member in members if rng.random() < .3]
+    return BenchGuild(members), role, points
+
+
+def legacy_users_for_role(users_and_points, server, point_check_fn, role, adding_role, blacklisted_ids):
+    """Role evaluation as it was before: a scan of every member's role list."""
+    grant_users = []
+    ignored_users = []
+    userid_to_points = {x[0]: x[1] for x in users_and_points}
+    for user in server.members:
+        points = userid_to_points.get(user.id, 0)
+        if role in user.roles and adding_role:
+            continue
+        if role not in user.roles and not adding_role:
+            continue
+        if not point_check_fn(points):
+            continue
+        if user.id in blacklisted_ids:
+            ignored_users.append((user.id, points))
+        else:
+            grant_users.append((user.id, points))
+    return grant_users, ignored_users
+
+
+def membership_benchmark(member_counts=(10000, 100000), amount=50, repeat=3):
+    """Compare the member scan against set-based role evaluation, for a grant and a removal.
+
+    Returns a list of (members, check, scan ms, sets ms, sets without NumPy ms) tuples.
+    """
+    from .seniority import PointsTable, users_for_role
+
+    results = []
+    for count in member_counts:
+        guild, role, points = make_guild(count)
+        blacklisted_ids = set()
+        checks = [
+            ('grant', True, lambda p: p >= amount, dict(min_points=amount)),
+            ('remove', False, lambda p: p < amount, dict(max_points=amount)),
+        ]
+        for name, adding_role, point_check_fn, bounds in checks:
+            def scan():
+                return legacy_users_for_role(points, guild, point_check_fn, role, adding_role, blacklisted_ids)
+
+            def sets(use_numpy=True):
+                return users_for_role(PointsTable(points, use_numpy), guild, role, adding_role, blacklisted_ids,
+                                      **bounds)
+
+            expected = sorted(scan()[0])
+            if sorted(sets()[0]) != expected:
+                raise ValueError('Set-based evaluation disagrees with the member scan ({})'.format(name))
+
+            scan_ms = min(timeit.repeat(scan, number=1, repeat=repeat)) * 1e3
+            sets_ms = min(timeit.repeat(sets, number=1, repeat=repeat)) * 1e3
+            pure_ms = min(timeit.repeat(lambda: sets(use_numpy=False), number=1, repeat=repeat)) * 1e3
+            results.append((count, name, scan_ms, sets_ms, pure_ms))
+    return results
@@ -0,0 +1,137 @@
+import logging
+import os
+
+import aiosqlite
+
+logger = logging.getLogger('red.misc-cogs.seniority')
+
+# Applied to every connection.  WAL lets readers run alongside the flush writer, and with WAL
+# synchronous=NORMAL only syncs at checkpoints; a crash can lose the last commits but never
+# corrupts the file.  A negative cache_size is in KiB.
+CONNECTION_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16384',
+    'PRAGMA temp_store=MEMORY',
+]
+
+# Number of prepared statements sqlite3 keeps per connection
+STATEMENT_CACHE_SIZE = 128
+
+# PRAGMA user_version once the rows from the old ODBC database have been copied in
+SCHEMA_VERSION_LEGACY_COPIED = 1
+
+
+class SeniorityDB:
+    """A single native async SQLite connection.
+
+    Statements run in autocommit mode on aiosqlite's worker thread; writes that must land
+    together go through execute_transaction().  Query parameters are passed positionally,
+    the same way the old aioodbc cursors took them.
+    """
+
+    def __init__(self, path, pragmas=None):
+        self.path = path
+        self.pragmas = CONNECTION_PRAGMAS if pragmas is None else pragmas
+        self.conn = None
+
+    async def open(self):
+        self.conn = await aiosqlite.connect(self.path, isolation_level=None,
+                                            cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in self.pragmas:
+            await self.conn.execute(pragma)
+
+    async def close(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            await conn.close()
+
+    async def execute(self, query, *args):
+        await self.conn.execute(query, args)
+
+    async def fetchall(self, query, *args):
+        async with self.conn.execute(query, args) as cur:
+            return await cur.fetchall()
+
+    async def query(self, query, *args):
+        """Run a query, returning (column names, rows)."""
+        async with self.conn.execute(query, args) as cur:
+            rows = await cur.fetchall()
+            columns = [x[0] for x in cur.description] if cur.description else []
+        return columns, rows
+
+    async def execute_transaction(self, statements):
+        """Run a list of (query, [args, ...]) batches in one transaction."""
+        await self.conn.execute('BEGIN')
+        try:
+            for query, arg_rows in statements:
+                await self.conn.executemany(query, arg_rows)
+            await self.conn.execute('COMMIT')
+        except Exception:
+            await self.conn.execute('ROLLBACK')
+            raise
+
+    async def executemany(self, query, arg_rows):
+        await self.execute_transaction([(query, arg_rows)])
+
+    async def user_version(self):
+        rows = await self.fetchall('PRAGMA user_version')
+        return rows[0][0]
+
+    async def migrate_legacy(self, legacy_path, create_statements):
+        """Create the schema, copying rows out of the old aioodbc database the first time.
+
+        The old log.db is left untouched.  The copy and the version bump commit together,
+        so an interrupted migration is simply retried on the next start.
+        """
+        if await self.user_version() >= SCHEMA_VERSION_LEGACY_COPIED:
+            return
+        for statement in create_statements:
+            await self.execute(statement)
+
+        attached = copy = os.path.exists(legacy_path) and os.path.abspath(legacy_path) != os.path.abspath(self.path)
+        if attached:
+            logger.info('Seniority: copying rows from {}'.format(legacy_path))
+            await self.execute('ATTACH DATABASE ? AS legacy', legacy_path)
+            copy = bool(await self.fetchall(
+                "SELECT 1 FROM legacy.sqlite_master WHERE type = 'table' AND name = 'seniority'"))
+        try:
+            await self.conn.execute('BEGIN')
+            try:
+                if copy:
+                    await self.conn.execute('''
+                        INSERT OR REPLACE INTO main.seniority(record_date, server_id, channel_id, user_id, points)
+                        SELECT record_date, server_id, channel_id, user_id, points FROM legacy.seniority''')
+                await self.conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION_LEGACY_COPIED))
+                await self.conn.execute('COMMIT')
+            except Exception:
+                await self.conn.execute('ROLLBACK')
+                raise
+        finally:
+            if attached:
+                await self.execute('DETACH DATABASE legacy')
+
+    async def migrate(self, migrations):
+        """Apply each (version, [statements]) step newer than PRAGMA user_version.
+
+        A step's statements and its version bump commit together.  The file is vacuumed
+        afterwards to give back the pages of rebuilt tables.
+        """
+        version = await self.user_version()
+        applied = False
+        for step_version, statements in migrations:
+            if step_version <= version:
+                continue
+            logger.info('Seniority: migrating schema to version {}'.format(step_version))
+            await self.conn.execute('BEGIN')
+            try:
+                for statement in statements:
+                    await self.conn.execute(statement)
+                await self.conn.execute('PRAGMA user_version = {}'.format(step_version))
+                await self.conn.execute('COMMIT')
+            except Exception:
+                await self.conn.execute('ROLLBACK')
+                raise
+            applied = True
+        if applied:
+            await self.execute('VACUUM')
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+
+import discord
+
+logger = logging.getLogger('red.misc-cogs.seniority')
+
+
+class RoleChange:
+    __slots__ = ('member', 'role', 'add', 'error', 'retryable')
+
+    def __init__(self, member, role, add):
+        self.member = member
+        self.role = role
+        self.add = add
+        self.error = None
+        # Whether the last failure was transient, so trying again later may succeed
+        self.retryable = False
+
+
+def is_transient(ex):
+    """Whether a failed request is worth retrying: rate limits and server errors."""
+    return isinstance(ex, (discord.HTTPException, asyncio.TimeoutError, OSError)) \
+        and not isinstance(ex, (discord.Forbidden, discord.NotFound)) \
+        and getattr(ex, 'status', 500) in (429,) + tuple(range(500, 600))
+
+
+class RoleChanger:
+    """Adds and removes roles with bounded concurrency.
+
+    At most `concurrency` requests are in flight, and requests for the same guild start at
+    least `interval` seconds apart, which keeps well inside Discord's member update rate
+    limit.  Transient failures are retried up to `retries` times with exponential backoff;
+    anything else is recorded on the change and the rest carry on.
+    """
+
+    def __init__(self, concurrency=2, interval=.5, retries=3, backoff=2.):
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._next_request = {}
+
+    async def apply(self, changes, reason=None):
+        """Apply a list of RoleChange, returning (succeeded, failed) lists."""
+        await asyncio.gather(*(self._apply_one(change, reason) for change in changes))
+        succeeded = [change for change in changes if change.error is None]
+        failed = [change for change in changes if change.error is not None]
+        return succeeded, failed
+
+    async def _apply_one(self, change, reason):
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                await self._wait_turn(change.member.guild.id)
+                try:
+                    if change.add:
+                        await change.member.add_roles(change.role, reason=reason)
+                    else:
+                        await change.member.remove_roles(change.role, reason=reason)
+                    change.error = None
+                    change.retryable = False
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except Exception as ex:
+                    change.error = str(ex) or type(ex).__name__
+                    change.retryable = is_transient(ex)
+                    if not change.retryable or attempt == self.retries:
+                        logger.warning('Failed to {} role {} for {}: {}'.format(
+                            'add' if change.add else 'remove', change.role.id, change.member.id, change.error))
+                        return
+                    await asyncio.sleep(self.backoff ** attempt)
+
+    async def _wait_turn(self, guild_id):
+        # Reserve the next slot before sleeping, so concurrent requests queue up behind it
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_request.get(guild_id, 0))
+        self._next_request[guild_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
@@ -1,15 +1,15 @@
-import aioodbc
+import asyncio
 import discord
 import logging
-import os
 import prettytable
 import pytz
 import re
-import sys
 import timeit
 from io import BytesIO
 from collections import deque
-from datetime import datetime, timedelta
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+from datetime import date, datetime, time, timedelta, timezone
 from redbot.core import checks
 from redbot.core import commands
 from redbot.core.bot import Red
@@ -18,9 +18,32 @@ from redbot.core.utils.chat_formatting import box, inline, pagify
 from tsutils.cog_settings import CogSettings
 from tsutils.time import DISCORD_DEFAULT_TZ
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .db import SeniorityDB
+from .grants import RoleChange, RoleChanger
+
 logger = logging.getLogger('red.misc-cogs.seniority')
 
-CREATE_TABLE = '''
+# How often accumulated points are written back to the database
+FLUSH_INTERVAL_SECONDS = 30
+
+# How long a server's acceptability filter, and the command prefixes it holds, is reused
+ACCEPTABILITY_REFRESH_SECONDS = 5 * 60
+
+# Number of channels whose history is read at the same time during a catchup
+CATCHUP_CHANNEL_CONCURRENCY = 4
+
+# How often to look for opted-in servers whose daily auto grant hasn't run yet
+AUTO_GRANT_CHECK_SECONDS = 15 * 60
+
+EPOCH_DATE = date(1970, 1, 1)
+
+# The table as first written by the aioodbc backend, and copied out of log.db
+LEGACY_CREATE_TABLE = '''
 CREATE TABLE IF NOT EXISTS seniority(
   record_date STRING NOT NULL,
   server_id STRING NOT NULL,
@@ -30,58 +53,93 @@ CREATE TABLE IF NOT EXISTS seniority(
   PRIMARY KEY (record_date, server_id, channel_id, user_id))
 '''
 
-CREATE_INDEX_1 = '''
-CREATE INDEX IF NOT EXISTS idx_server_id_record_date_user_id
-ON seniority(server_id, record_date, user_id)
+# Snowflakes are stored as integers and dates as days since 1970-01-01 (see day_number).
+# The primary key serves every per-user lookup; the single index covers the per-server
+# day range scans.
+CREATE_TABLE = '''
+CREATE TABLE IF NOT EXISTS seniority(
+  server_id INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  day INTEGER NOT NULL,
+  channel_id INTEGER NOT NULL,
+  points REAL NOT NULL DEFAULT 0,
+  PRIMARY KEY (server_id, user_id, day, channel_id))
+WITHOUT ROWID
 '''
 
-# Why?
-CREATE_INDEX_2 = '''
-CREATE INDEX IF NOT EXISTS idx_record_date_server_id_user_id
-ON seniority(record_date, server_id, user_id)
+CREATE_INDEX = '''
+CREATE INDEX IF NOT EXISTS idx_server_id_day
+ON seniority(server_id, day)
 '''
 
-# Why? record date should never come first
-CREATE_INDEX_3 = '''
-CREATE INDEX IF NOT EXISTS idx_record_date_server_id_channel_id_user_id
-ON seniority(record_date, server_id, channel_id, user_id)
+COPY_LEGACY_ROWS = '''
+INSERT INTO seniority(server_id, user_id, day, channel_id, points)
+SELECT CAST(server_id AS INTEGER),
+       CAST(user_id AS INTEGER),
+       CAST(julianday(record_date) - 2440587.5 AS INTEGER),
+       CAST(channel_id AS INTEGER),
+       COALESCE(points, 0)
+FROM seniority_legacy
+WHERE julianday(record_date) IS NOT NULL
 '''
 
-CREATE_INDEX_4 = '''
-CREATE INDEX IF NOT EXISTS idx_server_id_user_id_record_date
-ON seniority(server_id, user_id, record_date)
-'''
+# Applied in order by SeniorityDB.migrate(), each in its own transaction
+SCHEMA_MIGRATIONS = [
+    (2, [
+        'ALTER TABLE seniority RENAME TO seniority_legacy',
+        CREATE_TABLE,
+        COPY_LEGACY_ROWS,
+        'DROP TABLE seniority_legacy',
+        CREATE_INDEX,
+    ]),
+]
 
 GET_USER_POINTS_QUERY = '''
-SELECT record_date, round(sum(points), 2) as points
-FROM seniority INDEXED BY idx_server_id_user_id_record_date
+SELECT date(day * 86400, 'unixepoch') as record_date, round(sum(points), 2) as points
+FROM seniority
 WHERE server_id = ?
   AND user_id = ?
-GROUP BY 1
-ORDER BY 1 DESC
+GROUP BY day
+ORDER BY day DESC
 LIMIT ?
 '''
 
 GET_LOOKBACK_POINTS_QUERY = '''
 SELECT user_id, sum(points) as points
-FROM seniority INDEXED BY idx_server_id_user_id_record_date
+FROM seniority
 WHERE server_id = ?
-  AND record_date >= ?
+  AND day >= ?
 GROUP BY 1
 '''
 
+GET_DAY_RANGE_POINTS_QUERY = '''
+SELECT user_id, sum(points) as points
+FROM seniority
+WHERE server_id = ?
+  AND day >= ?
+  AND day < ?
+GROUP BY 1
+'''
+
+GET_SERVER_DATE_POINTS_QUERY = '''
+SELECT user_id, channel_id, points
+FROM seniority
+WHERE server_id = ?
+  AND day = ?
+'''
+
 GET_DATE_POINTS_QUERY = '''
 SELECT channel_id, points
-FROM seniority INDEXED BY idx_server_id_record_date_user_id
-WHERE record_date = ?
+FROM seniority
+WHERE day = ?
   AND server_id = ?
   AND user_id = ?
 '''
 
 GET_NEWMESSAGE_POINTS_QUERY = '''
 SELECT SUM(points) as points
-FROM seniority INDEXED BY idx_record_date_server_id_channel_id_user_id
-WHERE record_date = ?
+FROM seniority
+WHERE day = ?
   AND server_id = ?
   AND channel_id = ?
   AND user_id = ?
@@ -89,20 +147,20 @@ WHERE record_date = ?
 
 GET_NEWMESSAGE_SERVER_POINTS_QUERY = '''
 SELECT SUM(points) as points
-FROM seniority INDEXED BY idx_record_date_server_id_user_id
-WHERE record_date = ?
+FROM seniority
+WHERE day = ?
   AND server_id = ?
   AND user_id = ?
 '''
 
 REPLACE_POINTS_QUERY = '''
-REPLACE INTO seniority(record_date, server_id, channel_id, user_id, points)
+REPLACE INTO seniority(day, server_id, channel_id, user_id, points)
 VALUES(?, ?, ?, ?, ?)
 '''
 
 DELETE_DAY_QUERY = '''
 DELETE FROM seniority
-WHERE record_date = ?
+WHERE day = ?
   AND server_id = ?
 '''
 
@@ -112,7 +170,8 @@ WHERE user_id = ?
 '''
 
 GET_USER_DATA = '''
-SELECT * FROM seniority
+SELECT date(day * 86400, 'unixepoch') as record_date, server_id, channel_id, user_id, points
+FROM seniority
 WHERE user_id = ?
 '''
 
@@ -124,60 +183,147 @@ class Seniority(commands.Cog):
         super().__init__(*args, **kwargs)
         self.bot = bot
         self.settings = SenioritySettings("seniority")
-        self.db_path = self.settings.folder + '/log.db'
+        self.db_path = self.settings.folder + '/seniority.db'
+        # Written by the old aioodbc backend; copied into db_path on first start
+        self.legacy_db_path = self.settings.folder + '/log.db'
         self.lock = True
-        self.pool = None
+        self.db = None
         self.insert_timing = deque(maxlen=1000)
+        self.flush_timing = deque(maxlen=1000)
+        self.daily_points = DailyPoints()
+        # server_id -> lookback days -> RollingTotals
+        self.rolling_totals = {}
+        self.current_date = None
+        self._flush_task = None
+        self._auto_grant_task = None
+        self.role_changer = RoleChanger()
+        # server_id -> (AcceptabilityFilter, expiry time, GuildSettings it was built from)
+        self.acceptability_filters = {}
+        self.running_catchups = set()
+        self._flush_lock = asyncio.Lock()
 
     async def red_get_data_for_user(self, *, user_id):
         """Get a user's personal data."""
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_USER_DATA, user_id)
-                rows = await cur.fetchall()
+        await self.flush_points()
+        rows = await self.db.fetchall(GET_USER_DATA, user_id)
         guilds = len({r[1] for r in rows})
         data = "You have activity data stored in {} guilds.\n".format(guilds)
         return {"user_data.txt": BytesIO(data.encode())}
 
     async def red_delete_data_for_user(self, *, requester, user_id):
         """Delete a user's personal data."""
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(DELETE_USER_DATA, user_id)
+        self.daily_points.forget_user(user_id)
+        for windows in self.rolling_totals.values():
+            for window in windows.values():
+                window.forget_user(user_id)
+        await self.db.execute(DELETE_USER_DATA, user_id)
 
     def cog_unload(self):
         logger.debug('Seniority: unloading')
         self.lock = True
-        if self.pool:
-            self.pool.close()
-            self.bot.loop.create_task(self.pool.wait_closed())
-            self.pool = None
+        if self._flush_task:
+            self._flush_task.cancel()
+        if self._auto_grant_task:
+            self._auto_grant_task.cancel()
+        if self.db:
+            self.bot.loop.create_task(self.close_db(self.db))
+            self.db = None
         else:
-            logger.error('unexpected error: pool was None')
+            logger.error('unexpected error: db was None')
         logger.debug('Seniority: unloading complete')
 
+    async def close_db(self, db):
+        try:
+            await self.flush_points(db)
+        finally:
+            await db.close()
+
     async def init(self):
         logger.debug('Seniority: init')
         if not self.lock:
             logger.info('Seniority: bailing on unlock')
             return
 
-        if os.name != 'nt' and sys.platform != 'win32':
-            dsn = 'Driver=SQLite3;Database=' + self.db_path
-        else:
-            dsn = 'Driver=SQLite3 ODBC Driver;Database=' + self.db_path
-        self.pool = await aioodbc.create_pool(dsn=dsn, autocommit=True)
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(CREATE_TABLE)
-                await cur.execute(CREATE_INDEX_1)
-                await cur.execute(CREATE_INDEX_2)
-                await cur.execute(CREATE_INDEX_3)
-                await cur.execute(CREATE_INDEX_4)
+        db = SeniorityDB(self.db_path)
+        await db.open()
+        try:
+            await db.migrate_legacy(self.legacy_db_path, [LEGACY_CREATE_TABLE])
+            await db.migrate(SCHEMA_MIGRATIONS)
+        except Exception:
+            await db.close()
+            raise
+        self.db = db
         self.lock = False
+        self._flush_task = self.bot.loop.create_task(self.flush_points_loop())
+        self._auto_grant_task = self.bot.loop.create_task(self.auto_grant_loop())
 
         logger.debug('Seniority: init complete')
 
+    async def flush_points_loop(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+            try:
+                await self.flush_points()
+            except Exception:
+                logger.exception('Error flushing points')
+
+    async def flush_points(self, db=None):
+        """Write changed points back to the database in a single transaction.
+
+        Rows for days other than today are dropped from memory once written.
+        """
+        db = db or self.db
+        if db is None:
+            return
+        async with self._flush_lock:
+            await self.write_points(db, self.daily_points.take_dirty())
+            self.daily_points.evict_except(now_date())
+
+    async def auto_grant_loop(self):
+        await self.bot.wait_until_ready()
+        while True:
+            if not self.lock:
+                today = now_date()
+                for server_id in list(self.settings.servers()):
+                    guild_settings = self.settings.guild_settings(server_id)
+                    if not guild_settings.auto_grant or guild_settings.last_auto_grant == today:
+                        continue
+                    guild = self.bot.get_guild(int(server_id))
+                    if guild is None:
+                        continue
+                    try:
+                        completed = await self.run_auto_grant(guild)
+                    except Exception:
+                        logger.exception('Error running auto grant for {}'.format(server_id))
+                        continue
+                    # An incomplete day is retried at the next check; changes already made drop out of the plan
+                    if completed:
+                        self.settings.set_last_auto_grant(server_id, today)
+            await asyncio.sleep(AUTO_GRANT_CHECK_SECONDS)
+
+    async def write_points(self, db, rows):
+        """Write rows taken from daily_points.  Callers must hold _flush_lock."""
+        if not rows:
+            return
+        before_time = timeit.default_timer()
+        try:
+            await db.executemany(REPLACE_POINTS_QUERY, [(day_number(r[0]),) + r[1:] for r in rows])
+        except Exception:
+            self.daily_points.mark_dirty(rows)
+            raise
+        self.flush_timing.append((timeit.default_timer() - before_time, len(rows)))
+
+    async def rollover(self):
+        """Write out the previous day's points and move every rolling window forward."""
+        try:
+            await self.flush_points()
+            today = day_number(now_date())
+            for server_id, windows in list(self.rolling_totals.items()):
+                for window in list(windows.values()):
+                    await self.advance_rolling_totals(server_id, window, today - window.lookback)
+        except Exception:
+            logger.exception('Error rolling over to a new day')
+
     @commands.group()
     @commands.guild_only()
     @checks.mod_or_permissions(manage_guild=True)
@@ -192,11 +338,59 @@ class Seniority(commands.Cog):
     @seniority.command()
     @checks.is_owner()
     async def inserttiming(self, ctx):
+        msg = ''
         size = len(self.insert_timing)
-        avg_time = round(sum(self.insert_timing) / size, 4)
-        max_time = round(max(self.insert_timing), 4)
-        min_time = round(min(self.insert_timing), 4)
-        await ctx.send(inline('{} inserts, min={} max={} avg={}'.format(size, min_time, max_time, avg_time)))
+        if size:
+            avg_time = round(sum(self.insert_timing) / size, 4)
+            max_time = round(max(self.insert_timing), 4)
+            min_time = round(min(self.insert_timing), 4)
+            msg += '{} inserts, min={} max={} avg={}\n'.format(size, min_time, max_time, avg_time)
+        size = len(self.flush_timing)
+        if size:
+            times = [t for t, _ in self.flush_timing]
+            rows = sum(r for _, r in self.flush_timing)
+            msg += '{} flushes ({} rows), min={} max={} avg={}\n'.format(
+                size, rows, round(min(times), 4), round(max(times), 4), round(sum(times) / size, 4))
+        msg += '{} rows pending'.format(self.daily_points.pending())
+        await ctx.send(box(msg))
+
+    @seniority.group()
+    @checks.is_owner()
+    async def benchmark(self, ctx):
+        """Run synthetic seniority benchmarks."""
+
+    @benchmark.command(name='insert')
+    async def bm_insert(self, ctx, count: int = 2000):
+        """Compare per-message point write latency of the old and new storage backends."""
+        from .benchmark import insert_benchmark
+        create_statements = [CREATE_TABLE, CREATE_INDEX]
+        async with ctx.typing():
+            results = await self.bot.loop.run_in_executor(
+                None, lambda: insert_benchmark(create_statements, REPLACE_POINTS_QUERY, count))
+        tbl = prettytable.PrettyTable(["Backend", "p50 (us)", "p99 (us)", "mean (us)"])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for name, p50, p99, mean in results:
+            if p50 is None:
+                tbl.add_row([name, 'unavailable', '', ''])
+            else:
+                tbl.add_row([name, round(p50, 1), round(p99, 1), round(mean, 1)])
+        await ctx.send(box(tbl.get_string()))
+
+    @benchmark.command(name='membership')
+    async def bm_membership(self, ctx):
+        """Compare role evaluation by member scan and by set arithmetic at 10k/100k members."""
+        from .benchmark import membership_benchmark
+        async with ctx.typing():
+            results = await self.bot.loop.run_in_executor(None, membership_benchmark)
+        tbl = prettytable.PrettyTable(["Members", "Check", "Scan (ms)", "Sets (ms)", "Sets, no NumPy (ms)"])
+        tbl.hrules = prettytable.HEADER
+        tbl.vrules = prettytable.NONE
+        tbl.align = 'l'
+        for count, name, scan_ms, sets_ms, pure_ms in results:
+            tbl.add_row([count, name, round(scan_ms, 2), round(sets_ms, 2), round(pure_ms, 2)])
+        await ctx.send(box(tbl.get_string()))
 
     @seniority.command()
     @checks.is_owner()
@@ -286,58 +480,124 @@ class Seniority(commands.Cog):
     @grant.command()
     @commands.guild_only()
     async def grantnow(self, ctx):
-        """List users above the grant amount."""
-        guild = ctx.guild
-        lookback_days = self.settings.grant_lookback(guild.id)
-        for role_id, role, amount in self.roles_and_amounts(guild, 'grant_amount'):
-            if role is None or amount <= 0:
-                continue
-
-            msg = 'Granting for role {} (point cutoff {})'.format(role.name, amount)
-            await ctx.send(inline(msg))
-
-            grant_users, ignored_users = await self.get_grant_ignore_users(
-                guild, role, amount, lookback_days, True)
-            grant_users = [guild.get_member(int(x[0])) for x in grant_users]
-
-            cs = 5
-            user_chunks = [grant_users[i:i + cs] for i in range(0, len(grant_users), cs)]
-            for chunk in user_chunks:
-                msg = 'Granting to users: ' + ','.join([m.name for m in chunk])
-                await ctx.send(inline(msg))
-                for member in chunk:
-                    try:
-                        await member.add_roles(role)
-                    except Exception as ex:
-                        raise commands.UserFeedbackCheckFailure(str(ex))
+        """Grant roles to users above the grant amount."""
+        await self.do_change_roles(ctx, ctx.guild, True)
 
     @grant.command()
     @commands.guild_only()
     async def removenow(self, ctx):
-        """List users below the remove amount."""
-        server = ctx.guild
-        lookback_days = self.settings.remove_lookback(server.id)
-        for role_id, role, amount in self.roles_and_amounts(server, 'remove_amount'):
-            if role is None or amount <= 0:
+        """Remove roles from users below the remove amount."""
+        await self.do_change_roles(ctx, ctx.guild, False)
+
+    @grant.command()
+    @commands.guild_only()
+    async def autonow(self, ctx):
+        """Run the automatic grant and removal now, posting the summary to the announce channel."""
+        if self.get_announce_channel(ctx.guild.id) is None:
+            await ctx.send(inline('No announce channel set, the summary will not be posted'))
+        async with ctx.typing():
+            await self.run_auto_grant(ctx.guild)
+        await ctx.tick()
+
+    async def do_change_roles(self, ctx: Context, guild: discord.Guild, adding_role: bool):
+        changes = []
+        for role, grant_users, remove_users, _ in await self.plan_role_changes(guild):
+            users = grant_users if adding_role else remove_users
+            if not users:
                 continue
+            members = [m for m in (guild.get_member(user_id) for user_id, _ in users) if m]
+            msg = '{} role {}: {}'.format('Granting' if adding_role else 'Removing', role.name,
+                                          ', '.join(m.name for m in members))
+            for page in pagify(msg, page_length=1990):
+                await ctx.send(inline(page))
+            changes.extend(RoleChange(m, role, adding_role) for m in members)
+
+        async with ctx.typing():
+            succeeded, failed = await self.role_changer.apply(changes, reason='Seniority')
+        msg = '{} role changes made'.format(len(succeeded))
+        if failed:
+            msg += ', {} failed:'.format(len(failed))
+            msg += ''.join('\n\t{} ({}) : {}'.format(c.member.name, c.role.name, c.error) for c in failed)
+        for page in pagify(msg, page_length=1990):
+            await ctx.send(box(page))
 
-            msg = 'Removing for role {} (point cutoff {})'.format(role.name, amount)
-            await ctx.send(inline(msg))
+    async def plan_role_changes(self, guild: discord.Guild):
+        """Every configured role's (role, grant users, remove users, warn users).
 
-            grant_users, ignored_users = await self.get_grant_ignore_users(
-                server, role, amount, lookback_days, False)
-            grant_users = [server.get_member(int(x[0])) for x in grant_users]
+        Each list holds (user_id, points) for users who are not blacklisted.  The grant
+        and remove windows are each read once for all of the roles.
+        """
+        guild_settings = self.settings.guild_settings(guild.id)
+        grant_lookback = guild_settings.grant_lookback
+        remove_lookback = guild_settings.remove_lookback
+        grant_points = PointsTable(await self.get_lookback_points(guild, grant_lookback))
+        if remove_lookback == grant_lookback:
+            remove_points = grant_points
+        else:
+            remove_points = PointsTable(await self.get_lookback_points(guild, remove_lookback))
 
-            cs = 5
-            user_chunks = [grant_users[i:i + cs] for i in range(0, len(grant_users), cs)]
-            for chunk in user_chunks:
-                msg = 'Removing from users: ' + ','.join([m.name for m in chunk])
-                await ctx.send(inline(msg))
-                for member in chunk:
-                    try:
-                        await member.remove_roles(role)
-                    except Exception as ex:
-                        raise commands.UserFeedbackCheckFailure(str(ex))
+        plans = []
+        for role_id, role_config in guild_settings.roles.items():
+            role = guild.get_role(role_id)
+            if role is None:
+                continue
+            grant_amount = role_config['grant_amount']
+            warn_amount = role_config['warn_amount']
+            remove_amount = role_config['remove_amount']
+
+            grant_users, remove_users, warn_users = [], [], []
+            if grant_amount > 0:
+                grant_users, _ = self.check_users_for_role(
+                    grant_points, guild, role, True, min_points=grant_amount)
+                if warn_amount > 0:
+                    warn_users, _ = self.check_users_for_role(
+                        grant_points, guild, role, True, min_points=warn_amount, max_points=grant_amount)
+            if remove_amount > 0:
+                remove_users, _ = self.check_users_for_role(
+                    remove_points, guild, role, False, max_points=remove_amount)
+            plans.append((role, grant_users, remove_users, warn_users))
+        return plans
+
+    async def run_auto_grant(self, guild: discord.Guild):
+        """Grant and remove every configured role, then post one summary to the announce channel.
+
+        Returns False if some changes failed for reasons worth retrying, like a Discord outage.
+        """
+        plans = await self.plan_role_changes(guild)
+        changes = []
+        for role, grant_users, remove_users, _ in plans:
+            for users, adding_role in ((grant_users, True), (remove_users, False)):
+                for user_id, _ in users:
+                    member = guild.get_member(user_id)
+                    if member:
+                        changes.append(RoleChange(member, role, adding_role))
+        succeeded, failed = await self.role_changer.apply(changes, reason='Seniority auto grant')
+
+        msg = 'Seniority auto grant for {}'.format(now_date())
+        for role, _, _, warn_users in plans:
+            granted = [c.member.name for c in succeeded if c.role == role and c.add]
+            removed = [c.member.name for c in succeeded if c.role == role and not c.add]
+            msg += '\n\n{}: {} granted, {} removed, {} near grant'.format(
+                role.name, len(granted), len(removed), len(warn_users))
+            if granted:
+                msg += '\n\tGranted: ' + ', '.join(granted)
+            if removed:
+                msg += '\n\tRemoved: ' + ', '.join(removed)
+            if warn_users:
+                members = (guild.get_member(user_id) for user_id, _ in warn_users)
+                msg += '\n\tNear grant: ' + ', '.join(m.name for m in members if m)
+        if failed:
+            msg += '\n\nFailed:'
+            msg += ''.join('\n\t{} ({} {}) : {}'.format(
+                c.member.name, 'add' if c.add else 'remove', c.role.name, c.error) for c in failed)
+
+        announce_channel = self.get_announce_channel(guild.id)
+        if announce_channel is None:
+            logger.info('No announce channel for {}: {}'.format(guild.id, msg))
+        else:
+            for page in pagify(msg, page_length=1990):
+                await announce_channel.send(box(page))
+        return not any(c.retryable for c in failed)
 
     async def do_print_overages(self,
                                 ctx: Context,
@@ -346,6 +606,7 @@ class Seniority(commands.Cog):
                                 check_name: str,
                                 points_greater_than: bool):
         await ctx.send(inline('Displaying info for all roles'))
+        points_table = PointsTable(await self.get_lookback_points(server, lookback_days))
 
         for role_id, role, amount in self.roles_and_amounts(server, check_name):
             if role is None:
@@ -356,8 +617,12 @@ class Seniority(commands.Cog):
                 await ctx.send(inline('Skipping role {} (disabled)'.format(role.name)))
                 continue
 
-            grant_users, ignored_users = await self.get_grant_ignore_users(
-                server, role, amount, lookback_days, points_greater_than)
+            if points_greater_than:
+                grant_users, ignored_users = self.check_users_for_role(
+                    points_table, server, role, True, min_points=amount)
+            else:
+                grant_users, ignored_users = self.check_users_for_role(
+                    points_table, server, role, False, max_points=amount)
 
             def process_userlist(user_list):
                 r = ''
@@ -382,63 +647,75 @@ class Seniority(commands.Cog):
             role = server.get_role(role_id)
             yield role_id, role, role_config[check_name]
 
-    async def get_grant_ignore_users(self,
-                                     server: discord.Guild,
-                                     role: discord.Role,
-                                     amount: int,
-                                     lookback_days: int,
-                                     points_greater_than: bool):
-
-        if points_greater_than:
-            def point_check_fn(p):
-                return p >= amount
-        else:
-            def point_check_fn(p):
-                return p < amount
-
-        users_and_points = await self.get_lookback_points(server, lookback_days)
-        grant_users, ignored_users = self.check_users_for_role(
-            users_and_points, server, point_check_fn, role, points_greater_than)
-
-        return grant_users, ignored_users
-
     async def get_lookback_points(self, server: discord.Guild, lookback_days: int):
-        lookback_date = datetime.now(DISCORD_DEFAULT_TZ) - timedelta(days=lookback_days)
-        lookback_date_str = lookback_date.date().isoformat()
-
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_LOOKBACK_POINTS_QUERY, server.id, lookback_date_str)
-                rows = await cur.fetchall()
-                return [(int(x[0]), x[1]) for x in rows]
+        """Every user's (user_id, points) total since lookback_days ago."""
+        start_day = day_number(now_date()) - lookback_days
+
+        windows = self.rolling_totals.setdefault(server.id, {})
+        guild_settings = self.settings.guild_settings(server.id)
+        configured = {guild_settings.grant_lookback, guild_settings.remove_lookback}
+        for lookback in list(windows):
+            if lookback not in configured:
+                del windows[lookback]
+
+        window = windows.get(lookback_days)
+        if window is None or start_day - window.start_day > lookback_days:
+            window = await self.load_rolling_totals(server.id, lookback_days, start_day)
+        elif window.start_day < start_day:
+            await self.advance_rolling_totals(server.id, window, start_day)
+        return window.items()
+
+    async def load_rolling_totals(self, server_id, lookback_days: int, start_day: int):
+        """Build a server's rolling totals from the database.
+
+        The window is registered and the pending points are taken in one step, so every
+        point is counted exactly once: either it is written before the query runs, or it
+        is added to the window as it accrues.
+        """
+        async with self._flush_lock:
+            window = RollingTotals(lookback_days, start_day)
+            self.rolling_totals.setdefault(server_id, {})[lookback_days] = window
+            try:
+                await self.write_points(self.db, self.daily_points.take_dirty())
+                rows = await self.db.fetchall(GET_LOOKBACK_POINTS_QUERY, server_id, start_day)
+            except Exception:
+                self.rolling_totals[server_id].pop(lookback_days, None)
+                raise
+            window.add_rows(rows)
+        return window
+
+    async def advance_rolling_totals(self, server_id, window, start_day: int):
+        """Subtract the days which have fallen out of a rolling window."""
+        async with self._flush_lock:
+            old_start_day = window.start_day
+            if old_start_day >= start_day:
+                return
+            window.start_day = start_day
+            try:
+                await self.write_points(self.db, self.daily_points.take_dirty())
+                rows = await self.db.fetchall(GET_DAY_RANGE_POINTS_QUERY, server_id, old_start_day, start_day)
+            except Exception:
+                self.rolling_totals.get(server_id, {}).pop(window.lookback, None)
+                raise
+            window.add_rows(rows, sign=-1)
+
+    def add_rolling_points(self, server_id, date_str: str, user_id, points):
+        windows = self.rolling_totals.get(server_id)
+        if windows:
+            day = day_number(date_str)
+            for window in windows.values():
+                window.add(day, user_id, points)
 
     def check_users_for_role(self,
-                             users_and_points,
+                             points_table,
                              server: discord.Guild,
-                             point_check_fn,
                              role: discord.Role,
-                             adding_role: bool):
-        blacklisted_ids = self.settings.blacklist(server.id).keys()
-
-        grant_users = []
-        ignored_users = []
-
-        userid_to_points = {x[0]: x[1] for x in users_and_points}
-        for user in server.members:
-            points = userid_to_points.get(user.id, 0)
-            if role in user.roles and adding_role:
-                continue
-            if role not in user.roles and not adding_role:
-                continue
-            if not point_check_fn(points):
-                continue
-
-            if user.id in blacklisted_ids:
-                ignored_users.append((user.id, points))
-            else:
-                grant_users.append((user.id, points))
-
-        return grant_users, ignored_users
+                             adding_role: bool,
+                             min_points=None,
+                             max_points=None):
+        """Split the users a role change applies to into (changed users, ignored users)."""
+        blacklisted_ids = self.settings.guild_settings(server.id).blacklist
+        return users_for_role(points_table, server, role, adding_role, blacklisted_ids, min_points, max_points)
 
     @seniority.command()
     @commands.guild_only()
@@ -446,6 +723,7 @@ class Seniority(commands.Cog):
         """Display the points per day for a user."""
         limit = min(limit, 90)
         server = ctx.guild
+        await self.flush_points()
         args = [server.id, user.id, limit]
         await self.queryAndPrint(ctx, server, GET_USER_POINTS_QUERY, args, reverse=True, total=True)
 
@@ -454,7 +732,8 @@ class Seniority(commands.Cog):
     async def usercurrent(self, ctx, user: discord.User):
         """Display the current day's points for a user."""
         server = ctx.guild
-        args = [now_date(), server.id, user.id]
+        await self.flush_points()
+        args = [day_number(now_date()), server.id, user.id]
         await self.queryAndPrint(ctx, server, GET_DATE_POINTS_QUERY, args)
 
     @seniority.command()
@@ -481,12 +760,17 @@ class Seniority(commands.Cog):
     async def checktext(self, ctx, *, text: str):
         """Check if text is considered significant by the current config.
         """
-        ctx.message.content = text
-        is_good, cleaned_text, reason = await self.check_acceptable(ctx.message, text)
+        acceptability = await self.get_acceptability_filter(ctx.guild)
+        timings = []
+        is_good, cleaned_text, reason = acceptability.check(text, timings)
         if is_good:
-            await ctx.send(box('Message accepted, cleaned text:\n{}'.format(cleaned_text)))
+            msg = 'Message accepted, cleaned text:\n{}'.format(cleaned_text)
         else:
-            await ctx.send(box('Message rejected ({}), cleaned text:\n{}'.format(reason, cleaned_text)))
+            msg = 'Message rejected at {} ({}), cleaned text:\n{}'.format(timings[-1][0], reason, cleaned_text)
+        msg += '\n\nStages:'
+        for stage, seconds in timings:
+            msg += '\n\t{} : {}us'.format(stage, round(seconds * 1e6, 1))
+        await ctx.send(box(msg))
 
     @seniority.group()
     @commands.guild_only()
@@ -652,50 +936,157 @@ class Seniority(commands.Cog):
         await ctx.send(inline('Min word count set to {}.'.format(words)))
 
     async def check_acceptable(self, message: discord.Message, text: str):
-        server = message.guild
-        server_id = server.id
-        if self.settings.ignore_commands(server_id):
-            if (await self.bot.get_context(message)).prefix:
-                return False, text, 'Ignored command'
-
-        if self.settings.ignore_room_codes(server_id):
-            if re.match(r'.*\d{4}\s?\d{4}.*', text):
-                return False, text, 'Ignored room code'
-
-        if self.settings.ignore_emoji(server_id):
-            text = re.sub(r'<:[0-9a-z_]+:\d{18}>', '', text, re.IGNORECASE)
-
-        if self.settings.ignore_mentions(server_id):
-            text = re.sub(r'<@\d{18}>', '', text, re.IGNORECASE)
-
-        if len(text) < self.settings.min_length(server_id):
-            return False, text, 'Min length'
-
-        if len(text.split()) < self.settings.min_words(server_id):
-            return False, text, 'Min words'
-
-        return True, text, 'Passed!'
+        acceptability = await self.get_acceptability_filter(message.guild)
+        return acceptability.check(text)
+
+    def cached_acceptability_filter(self, server_id):
+        """The server's acceptability filter, or None if it needs to be (re)built."""
+        cached = self.acceptability_filters.get(server_id)
+        if cached is None or cached[1] < timeit.default_timer() \
+                or cached[2] is not self.settings.guild_settings(server_id):
+            return None
+        return cached[0]
+
+    async def get_acceptability_filter(self, server: discord.Guild):
+        acceptability = self.cached_acceptability_filter(server.id)
+        if acceptability is not None:
+            return acceptability
+
+        guild_settings = self.settings.guild_settings(server.id)
+        prefixes = ()
+        if guild_settings.ignore_commands:
+            prefixes = await self.bot.get_valid_prefixes(server)
+        acceptability = AcceptabilityFilter(
+            prefixes=prefixes,
+            ignore_room_codes=guild_settings.ignore_room_codes,
+            ignore_emoji=guild_settings.ignore_emoji,
+            ignore_mentions=guild_settings.ignore_mentions,
+            min_length=guild_settings.min_length,
+            min_words=guild_settings.min_words)
+        self.acceptability_filters[server.id] = (
+            acceptability, timeit.default_timer() + ACCEPTABILITY_REFRESH_SECONDS, guild_settings)
+        return acceptability
 
     @commands.Cog.listener("on_message")
     async def on_message(self, message: discord.Message):
         if message.guild is None:
             return
         now_date_str = now_date()
+        if now_date_str != self.current_date:
+            # Day rollover; write out yesterday's points, drop them from memory and
+            # move the rolling windows forward
+            if self.current_date is not None and not self.lock:
+                self.bot.loop.create_task(self.rollover())
+            self.current_date = now_date_str
         await self.process_message(message, now_date_str)
         
     @seniority.command()
     @commands.guild_only()
     async def catchup(self, ctx, days_ago_start: int, days_ago_end: int = 0):
-        """Catchup messages from `days_ago_start` days ago to `days_ago_end` days ago"""
-        for cid in self.settings.channels(ctx.guild.id):
-            channel = self.bot.get_channel(cid)
-            if channel is None:
-                continue
-            async for m in channel.history(after=datetime.utcnow()-timedelta(days=days_ago_start), 
-                                           before=datetime.utcnow()-timedelta(days=days_ago_end)):
-                await self.process_message(m, m.created_at.date().isoformat())
+        """Catchup messages from `days_ago_start` days ago to `days_ago_end` days ago
+
+        Days (in UTC) are processed oldest first.  If the catchup is interrupted, continue
+        it with `[p]seniority catchupresume`.
+        """
+        today = datetime.now(timezone.utc).date()
+        progress = {
+            'next_date': (today - timedelta(days=days_ago_start)).isoformat(),
+            'end_date': (today - timedelta(days=days_ago_end)).isoformat(),
+        }
+        self.settings.set_catchup(ctx.guild.id, progress)
+        await self.run_catchup(ctx, progress)
+
+    @seniority.command()
+    @commands.guild_only()
+    async def catchupresume(self, ctx):
+        """Continue an interrupted catchup from the first day it did not finish."""
+        progress = self.settings.catchup(ctx.guild.id)
+        if not progress:
+            await ctx.send(inline('No catchup to resume'))
+            return
+        await self.run_catchup(ctx, progress)
+
+    async def run_catchup(self, ctx, progress):
+        guild = ctx.guild
+        if self.lock:
+            await ctx.send(inline('Seniority is locked'))
+            return
+        if guild.id in self.running_catchups:
+            await ctx.send(inline('A catchup is already running'))
+            return
+
+        self.running_catchups.add(guild.id)
+        try:
+            day = date.fromisoformat(progress['next_date'])
+            end_day = date.fromisoformat(progress['end_date'])
+            total_days = (end_day - day).days + 1
+            status = await ctx.send(inline('Catchup: starting {} days from {}'.format(total_days, day)))
+            done_days = total_messages = total_points = 0
+            while day <= end_day:
+                messages, points = await self.catchup_day(guild, day)
+                done_days += 1
+                total_messages += messages
+                total_points += points
+                progress['next_date'] = (day + timedelta(days=1)).isoformat()
+                self.settings.set_catchup(guild.id, progress)
+                await status.edit(content=inline('Catchup: {}/{} days, through {} ({} messages, {} points)'.format(
+                    done_days, total_days, day, total_messages, round(total_points, 2))))
+                day += timedelta(days=1)
+            self.settings.set_catchup(guild.id, None)
+        finally:
+            self.running_catchups.discard(guild.id)
         await ctx.tick()
 
+    async def catchup_day(self, guild: discord.Guild, day: date):
+        """Award points for one UTC day of history in every tracked channel.
+
+        Channels are read concurrently.  Accepted messages are then scored in the order
+        they were sent, with the same caps as live messages, and the day is written in one
+        batch.  Returns (messages read, points awarded).
+        """
+        day_start = datetime.combine(day, time(), tzinfo=timezone.utc)
+        day_end = day_start + timedelta(days=1)
+        date_str = day.isoformat()
+        channel_max_ppd = self.settings.guild_settings(guild.id).channels
+        acceptability = await self.get_acceptability_filter(guild)
+        semaphore = asyncio.Semaphore(CATCHUP_CHANNEL_CONCURRENCY)
+
+        async def read_channel(channel_id):
+            channel = self.bot.get_channel(channel_id)
+            accepted = []
+            read = 0
+            if channel is None:
+                return accepted, read
+            async with semaphore:
+                try:
+                    async for m in channel.history(limit=None, after=day_start, before=day_end):
+                        read += 1
+                        if m.author.id != self.bot.user.id and acceptability.check(m.content)[0]:
+                            accepted.append((m.created_at, channel_id, m.author.id))
+                except discord.Forbidden:
+                    logger.warning('Catchup: no access to history of {}'.format(channel_id))
+            return accepted, read
+
+        results = await asyncio.gather(*(read_channel(channel_id) for channel_id in channel_max_ppd))
+        messages = sorted(m for accepted, _ in results for m in accepted)
+        read = sum(count for _, count in results)
+
+        unloaded = {user_id for _, _, user_id in messages
+                    if not self.daily_points.is_loaded(date_str, guild.id, user_id)}
+        if unloaded:
+            user_rows = {}
+            for user_id, channel_id, points in await self.db.fetchall(
+                    GET_SERVER_DATE_POINTS_QUERY, guild.id, day_number(date_str)):
+                user_rows.setdefault(user_id, []).append((channel_id, points))
+            for user_id in unloaded:
+                self.daily_points.load(date_str, guild.id, user_id, user_rows.get(user_id, []))
+
+        awarded = 0
+        for _, channel_id, user_id in messages:
+            awarded += self.award_points(date_str, guild.id, channel_id, user_id, channel_max_ppd[channel_id])
+        await self.flush_points()
+        return read, awarded
+
     async def process_message(self, message: discord.Message, now_date_str: str):
         if self.lock:
             return
@@ -707,68 +1098,58 @@ class Seniority(commands.Cog):
         if guild is None or message.author.id == self.bot.user.id:
             return
 
-        channel_config = self.settings.channels(guild.id).get(channel.id, None)
-        if not channel_config:
+        max_points = self.settings.guild_settings(guild.id).channels.get(channel.id)
+        if not max_points:
             return
 
-        acceptable, _, _ = await self.check_acceptable(message, message.content)
+        acceptability = self.cached_acceptability_filter(guild.id) or await self.get_acceptability_filter(guild)
+        acceptable, _, _ = acceptability.check(message.content)
         if not acceptable:
             return
 
-        max_points = channel_config['max_ppd']
-        current_points = await self.get_current_channel_points(now_date_str, guild, channel, user)
-        current_points = current_points or 0
+        before_time = timeit.default_timer()
+        if not self.daily_points.is_loaded(now_date_str, guild.id, user.id):
+            rows = await self.get_user_date_points(now_date_str, guild, user)
+            self.daily_points.load(now_date_str, guild.id, user.id, rows)
+
+        awarded = self.award_points(now_date_str, guild.id, channel.id, user.id, max_points)
+        execution_time = timeit.default_timer() - before_time
+        self.insert_timing.append(execution_time)
+
+        return awarded
+
+    def award_points(self, date_str: str, server_id, channel_id, user_id, max_points):
+        """Credit one accepted message, within the channel and server caps.
+
+        The user's points for the date must already be loaded.  Returns the points added.
+        """
+        current_points = self.daily_points.channel_points(date_str, server_id, channel_id, user_id)
 
         if current_points >= max_points:
-            return
+            return 0
 
-        server_point_cap = self.settings.server_point_cap(guild.id)
-        current_server_points = await self.get_current_server_points(now_date_str, guild, user)
-        current_server_points = current_server_points or 0
+        guild_settings = self.settings.guild_settings(server_id)
+        current_server_points = self.daily_points.server_points(date_str, server_id, user_id)
 
-        if current_server_points >= server_point_cap:
-            return
+        if current_server_points >= guild_settings.server_point_cap:
+            return 0
 
-        message_cap = self.settings.message_cap(guild.id)
-        incremental_points = max_points / message_cap
+        incremental_points = max_points / guild_settings.message_cap
         new_points = current_points + incremental_points
         new_points = min(new_points, max_points)
 
-        before_time = timeit.default_timer()
-        await self.save_current_points(now_date_str, guild, channel, user, new_points)
-        execution_time = timeit.default_timer() - before_time
-        self.insert_timing.append(execution_time)
+        self.daily_points.set(date_str, server_id, channel_id, user_id, new_points)
+        self.add_rolling_points(server_id, date_str, user_id, new_points - current_points)
+        return new_points - current_points
 
-        return incremental_points
-
-    async def get_current_channel_points(self, now_date_str: str, server: discord.Guild, channel: discord.TextChannel,
-                                         user: discord.User):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_NEWMESSAGE_POINTS_QUERY, now_date_str, server.id, channel.id, user.id)
-                results = await cur.fetchone()
-                return results.points if results else 0
-
-    async def get_current_server_points(self, now_date_str: str, server: discord.Guild, user: discord.User):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(GET_NEWMESSAGE_SERVER_POINTS_QUERY, now_date_str, server.id, user.id)
-                results = await cur.fetchone()
-                return results.points if results else 0
-
-    async def save_current_points(self, now_date_str: str, server: discord.Guild, channel: discord.TextChannel,
-                                  user: discord.User, new_points: int):
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(REPLACE_POINTS_QUERY, now_date_str, server.id, channel.id, user.id, new_points)
+    async def get_user_date_points(self, now_date_str: str, server: discord.Guild, user: discord.User):
+        """All of a user's (channel_id, points) rows in a server for a date."""
+        rows = await self.db.fetchall(GET_DATE_POINTS_QUERY, day_number(now_date_str), server.id, user.id)
+        return [(int(x[0]), x[1]) for x in rows]
 
     async def queryAndPrint(self, ctx, server, query, values, max_rows=100, reverse=False, total=False):
         before_time = timeit.default_timer()
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(query, *values)
-                rows = await cur.fetchall()
-                columns = [x[0] for x in cur.description]
+        columns, rows = await self.db.query(query, *values)
         execution_time = timeit.default_timer() - before_time
 
         if reverse:
@@ -820,6 +1201,236 @@ class Seniority(commands.Cog):
             await ctx.send(box(p))
 
 
+class DailyPoints:
+    """Points per (date, server, channel, user), kept in memory and written back in batches.
+
+    A user's rows for a date are loaded from the database the first time they are needed.
+    Changed rows are tracked until they are taken for writing with take_dirty().
+    """
+
+    def __init__(self):
+        self._channel_points = {}
+        self._server_points = {}
+        self._loaded = set()
+        self._dirty = set()
+
+    def pending(self):
+        return len(self._dirty)
+
+    def is_loaded(self, date_str, server_id, user_id):
+        return (date_str, server_id, user_id) in self._loaded
+
+    def load(self, date_str, server_id, user_id, rows):
+        """Store a user's (channel_id, points) rows, unless another load already did."""
+        user_key = (date_str, server_id, user_id)
+        if user_key in self._loaded:
+            return
+        self._loaded.add(user_key)
+        for channel_id, points in rows:
+            self._channel_points[(date_str, server_id, channel_id, user_id)] = points or 0
+            self._server_points[user_key] = self._server_points.get(user_key, 0) + (points or 0)
+
+    def channel_points(self, date_str, server_id, channel_id, user_id):
+        return self._channel_points.get((date_str, server_id, channel_id, user_id), 0)
+
+    def server_points(self, date_str, server_id, user_id):
+        return self._server_points.get((date_str, server_id, user_id), 0)
+
+    def set(self, date_str, server_id, channel_id, user_id, points):
+        key = (date_str, server_id, channel_id, user_id)
+        user_key = (date_str, server_id, user_id)
+        old_points = self._channel_points.get(key, 0)
+        self._channel_points[key] = points
+        self._server_points[user_key] = self._server_points.get(user_key, 0) + points - old_points
+        self._dirty.add(key)
+
+    def take_dirty(self):
+        """Rows changed since the last call, as (date, server_id, channel_id, user_id, points)."""
+        rows = [key + (self._channel_points[key],) for key in self._dirty]
+        self._dirty = set()
+        return rows
+
+    def mark_dirty(self, rows):
+        """Put back rows which failed to write."""
+        self._dirty.update(tuple(row[:4]) for row in rows if tuple(row[:4]) in self._channel_points)
+
+    def evict_except(self, date_str):
+        """Drop clean rows for every date other than date_str."""
+        keep_users = {key[0:2] + key[3:] for key in self._dirty}
+        self._channel_points = {key: points for key, points in self._channel_points.items()
+                                if key[0] == date_str or key in self._dirty}
+        self._server_points = {key: points for key, points in self._server_points.items()
+                               if key[0] == date_str or key in keep_users}
+        self._loaded = {key for key in self._loaded if key[0] == date_str or key in keep_users}
+
+    def forget_user(self, user_id):
+        self._channel_points = {key: points for key, points in self._channel_points.items() if key[3] != user_id}
+        self._server_points = {key: points for key, points in self._server_points.items() if key[2] != user_id}
+        self._loaded = {key for key in self._loaded if key[2] != user_id}
+        self._dirty = {key for key in self._dirty if key[3] != user_id}
+
+
+class PointsTable:
+    """(user_id, points) totals prepared for repeated threshold queries.
+
+    With NumPy installed the ids and points are held as arrays, so each threshold is one
+    vectorised comparison rather than a Python loop over every user.  Pass use_numpy=False
+    to use the plain loop regardless.
+    """
+
+    def __init__(self, users_and_points, use_numpy=True):
+        self.points = dict(users_and_points)
+        self._ids = self._values = None
+        if use_numpy and numpy is not None and self.points:
+            self._ids = numpy.fromiter(self.points.keys(), dtype=numpy.int64, count=len(self.points))
+            self._values = numpy.fromiter(self.points.values(), dtype=numpy.float64, count=len(self.points))
+
+    def ids_in_range(self, min_points=None, max_points=None):
+        """Ids of users with min_points <= points < max_points; either bound may be None."""
+        if self._ids is not None:
+            mask = numpy.ones(len(self._ids), dtype=bool)
+            if min_points is not None:
+                mask &= self._values >= min_points
+            if max_points is not None:
+                mask &= self._values < max_points
+            return set(self._ids[mask].tolist())
+        return {user_id for user_id, points in self.points.items()
+                if (min_points is None or points >= min_points) and (max_points is None or points < max_points)}
+
+
+def users_for_role(points_table: PointsTable, server, role, adding_role: bool, blacklisted_ids,
+                   min_points=None, max_points=None):
+    """Members whose points are in [min_points, max_points) and who lack the role (when
+    adding) or hold it (when removing), as (changed, ignored) lists of (user_id, points).
+
+    Blacklisted users go in the ignored list.  Both lists are sorted by points, highest first.
+    """
+    holder_ids = {member.id for member in role.members}
+    in_range_ids = points_table.ids_in_range(min_points, max_points)
+    # Users without any points count as 0
+    zero_in_range = (min_points is None or min_points <= 0) and (max_points is None or max_points > 0)
+
+    if adding_role:
+        user_ids = {user_id for user_id in in_range_ids - holder_ids if server.get_member(user_id)}
+        if zero_in_range:
+            user_ids |= {member.id for member in server.members} - holder_ids - points_table.points.keys()
+    else:
+        user_ids = holder_ids & in_range_ids
+        if zero_in_range:
+            user_ids |= holder_ids - points_table.points.keys()
+
+    points = points_table.points
+    changed = sorted(((user_id, points.get(user_id, 0)) for user_id in user_ids - blacklisted_ids),
+                     key=lambda x: -x[1])
+    ignored = sorted(((user_id, points.get(user_id, 0)) for user_id in user_ids & blacklisted_ids),
+                     key=lambda x: -x[1])
+    return changed, ignored
+
+
+class AcceptabilityFilter:
+    """A server's text acceptability settings, compiled into an ordered set of checks.
+
+    Length and word count are checked on the raw text first: removing emoji and mentions
+    only makes text shorter, so anything too short to start with is rejected without
+    looking further.  Commands are recognised by a cached tuple of the server's prefixes.
+    """
+
+    # Matched from the start of the text; without DOTALL the leading .* keeps to the first line
+    ROOM_CODE_PATTERN = re.compile(r'.*\d{4}\s?\d{4}')
+    EMOJI_PATTERN = re.compile(r'<:[0-9a-z_]+:\d{18}>', re.IGNORECASE)
+    MENTION_PATTERN = re.compile(r'<@\d{18}>')
+
+    def __init__(self, prefixes, ignore_room_codes, ignore_emoji, ignore_mentions, min_length, min_words):
+        self.prefixes = tuple(prefixes)
+        self.ignore_room_codes = ignore_room_codes
+        self.ignore_emoji = ignore_emoji
+        self.ignore_mentions = ignore_mentions
+        self.min_length = min_length
+        self.min_words = min_words
+
+    def check(self, text: str, timings=None):
+        """Returns (acceptable, cleaned text, reason).
+
+        If a list is passed as timings, a (stage, seconds) pair is appended for every stage
+        that ran; the last one is the stage that decided the result.
+        """
+        stage_start = timeit.default_timer() if timings is not None else 0
+
+        def stage_done(stage):
+            nonlocal stage_start
+            if timings is not None:
+                now = timeit.default_timer()
+                timings.append((stage, now - stage_start))
+                stage_start = now
+
+        too_short = self._too_short(text)
+        stage_done('raw length')
+        if too_short:
+            return False, text, too_short
+
+        is_command = bool(self.prefixes) and text.startswith(self.prefixes)
+        stage_done('command prefix')
+        if is_command:
+            return False, text, 'Ignored command'
+
+        has_room_code = self.ignore_room_codes and self.ROOM_CODE_PATTERN.match(text)
+        stage_done('room code')
+        if has_room_code:
+            return False, text, 'Ignored room code'
+
+        if self.ignore_emoji:
+            text = self.EMOJI_PATTERN.sub('', text)
+        if self.ignore_mentions:
+            text = self.MENTION_PATTERN.sub('', text)
+        stage_done('strip emoji/mentions')
+
+        too_short = self._too_short(text)
+        stage_done('cleaned length')
+        if too_short:
+            return False, text, too_short
+        return True, text, 'Passed!'
+
+    def _too_short(self, text):
+        if len(text) < self.min_length:
+            return 'Min length'
+        if len(text.split()) < self.min_words:
+            return 'Min words'
+        return None
+
+
+class RollingTotals:
+    """Per-user point totals for a server over every day from start_day onwards.
+
+    Loaded once from the database, then kept current: points are added as they accrue,
+    and days are subtracted as they fall out of the window.
+    """
+
+    def __init__(self, lookback, start_day):
+        self.lookback = lookback
+        self.start_day = start_day
+        self._totals = {}
+
+    def add(self, day, user_id, points):
+        if day >= self.start_day:
+            self._totals[user_id] = self._totals.get(user_id, 0) + points
+
+    def add_rows(self, rows, sign=1):
+        """Add (or with sign=-1, subtract) (user_id, points) rows."""
+        for user_id, points in rows:
+            total = self._totals.get(user_id, 0) + sign * (points or 0)
+            # Drop users whose points have all expired, allowing for float residue
+            if total > 1e-6:
+                self._totals[user_id] = total
+            else:
+                self._totals.pop(user_id, None)
+
+    def items(self):
+        return list(self._totals.items())
+
+    def forget_user(self, user_id):
+        self._totals.pop(user_id, None)
+
+
 def ensure_map(item, key, default_value):
     if key not in item:
         item[key] = default_value
@@ -830,13 +1441,76 @@ def now_date():
     return datetime.now(DISCORD_DEFAULT_TZ).date().isoformat()
 
 
+def day_number(date_str: str):
+    """The stored day for an ISO date: days since 1970-01-01."""
+    return (date.fromisoformat(date_str) - EPOCH_DATE).days
+
+
+class GuildSettings(NamedTuple):
+    """An immutable view of one server's settings, with the defaults filled in."""
+    announce_channel: int
+    auto_grant: bool
+    message_cap: int
+    server_point_cap: int
+    grant_lookback: int
+    remove_lookback: int
+    last_auto_grant: str
+    ignore_commands: bool
+    ignore_emoji: bool
+    ignore_mentions: bool
+    ignore_room_codes: bool
+    min_length: int
+    min_words: int
+    # channel_id -> max points per day
+    channels: Mapping
+    # role_id -> {'remove_amount': ..., 'warn_amount': ..., 'grant_amount': ...}
+    roles: Mapping
+    blacklist: frozenset
+
+
 class SenioritySettings(CogSettings):
+    def __init__(self, *args, **kwargs):
+        # server_id -> GuildSettings, dropped whenever the settings are saved
+        self._guild_settings = {}
+        super().__init__(*args, **kwargs)
+
     def make_default_settings(self):
         config = {
             'servers': {}
         }
         return config
 
+    def save_settings(self):
+        self._guild_settings = {}
+        super().save_settings()
+
+    def guild_settings(self, server_id) -> GuildSettings:
+        """The server's settings, built once and reused until a setter saves a change."""
+        guild_settings = self._guild_settings.get(server_id)
+        if guild_settings is None:
+            config = self.config(server_id)
+            utterances = self.utterances(server_id)
+            guild_settings = self._guild_settings[server_id] = GuildSettings(
+                announce_channel=config['announce_channel'],
+                auto_grant=config['auto_grant'],
+                message_cap=config['message_cap'],
+                server_point_cap=config['server_point_cap'],
+                grant_lookback=config['grant_lookback'],
+                remove_lookback=config['remove_lookback'],
+                last_auto_grant=config['last_auto_grant'],
+                ignore_commands=utterances['ignore_commands'],
+                ignore_emoji=utterances['ignore_emoji'],
+                ignore_mentions=utterances['ignore_mentions'],
+                ignore_room_codes=utterances['ignore_room_codes'],
+                min_length=utterances['min_length'],
+                min_words=utterances['min_words'],
+                channels=MappingProxyType({channel_id: channel_config['max_ppd']
+                                           for channel_id, channel_config in self.channels(server_id).items()}),
+                roles=MappingProxyType({role_id: MappingProxyType(dict(role_config))
+                                        for role_id, role_config in self.roles(server_id).items()}),
+                blacklist=frozenset(int(user_id) for user_id in self.blacklist(server_id)))
+        return guild_settings
+
     def servers(self):
         return self.bot_settings['servers']
 
@@ -853,25 +1527,29 @@ class SenioritySettings(CogSettings):
         ensure_map(config, 'server_point_cap', 5)
         ensure_map(config, 'grant_lookback', 90)
         ensure_map(config, 'remove_lookback', 90)
+        ensure_map(config, 'last_auto_grant', '')
         return config
 
     def announce_channel(self, server_id: str):
-        return self.config(server_id)['announce_channel']
+        return self.guild_settings(server_id).announce_channel
 
     def auto_grant(self, server_id: str):
-        return self.config(server_id)['auto_grant']
+        return self.guild_settings(server_id).auto_grant
 
     def message_cap(self, server_id: str):
-        return self.config(server_id)['message_cap']
+        return self.guild_settings(server_id).message_cap
 
     def server_point_cap(self, server_id: str):
-        return self.config(server_id)['server_point_cap']
+        return self.guild_settings(server_id).server_point_cap
 
     def grant_lookback(self, server_id: str):
-        return self.config(server_id)['grant_lookback']
+        return self.guild_settings(server_id).grant_lookback
 
     def remove_lookback(self, server_id: str):
-        return self.config(server_id)['remove_lookback']
+        return self.guild_settings(server_id).remove_lookback
+
+    def last_auto_grant(self, server_id: str):
+        return self.guild_settings(server_id).last_auto_grant
 
     def set_announce_channel(self, server_id: str, channel_id):
         self.config(server_id)['announce_channel'] = channel_id
@@ -889,6 +1567,10 @@ class SenioritySettings(CogSettings):
         self.config(server_id)['server_point_cap'] = server_point_cap
         self.save_settings()
 
+    def set_last_auto_grant(self, server_id: str, date_str: str):
+        self.config(server_id)['last_auto_grant'] = date_str
+        self.save_settings()
+
     def set_grant_lookback(self, server_id: str, lookback: int):
         self.config(server_id)['grant_lookback'] = lookback
         self.save_settings()
@@ -932,22 +1614,22 @@ class SenioritySettings(CogSettings):
         return utterances
 
     def ignore_commands(self, server_id: str):
-        return self.utterances(server_id)['ignore_commands']
+        return self.guild_settings(server_id).ignore_commands
 
     def ignore_emoji(self, server_id: str):
-        return self.utterances(server_id)['ignore_emoji']
+        return self.guild_settings(server_id).ignore_emoji
 
     def ignore_mentions(self, server_id: str):
-        return self.utterances(server_id)['ignore_mentions']
+        return self.guild_settings(server_id).ignore_mentions
 
     def ignore_room_codes(self, server_id: str):
-        return self.utterances(server_id)['ignore_room_codes']
+        return self.guild_settings(server_id).ignore_room_codes
 
     def min_length(self, server_id: str):
-        return self.utterances(server_id)['min_length']
+        return self.guild_settings(server_id).min_length
 
     def min_words(self, server_id: str):
-        return self.utterances(server_id)['min_words']
+        return self.guild_settings(server_id).min_words
 
     def set_ignore_commands(self, server_id: str, ignore: bool):
         self.utterances(server_id)['ignore_commands'] = ignore
@@ -993,6 +1675,18 @@ class SenioritySettings(CogSettings):
         self.save_settings()
         return result
 
+    def catchup(self, server_id: str):
+        """Progress of an unfinished catchup: {'next_date': ..., 'end_date': ...}, or None."""
+        return self.server(server_id).get('catchup')
+
+    def set_catchup(self, server_id: str, progress):
+        server = self.server(server_id)
+        if progress is None:
+            server.pop('catchup', None)
+        else:
+            server['catchup'] = dict(progress)
+        self.save_settings()
+
     def channels(self, server_id: str):
         server = self.server(server_id)
         return ensure_map(server, 'channels', {})